@@ -69,15 +69,16 @@ class Agent(object):
         
         # Walk to random CP
         if self.goal is None:
-            self.goal = obs.cps[random.randint(0,len(obs.cps)-1)][0:2]
+            self.goal = tuple(obs.cps[int(rand() * len(obs.cps))][0:2])
         
         # Shoot enemies
         shoot = False
         if (obs.ammo > 0 and 
-            obs.foes and 
+            len(obs.foes) > 0 and 
             point_dist(obs.foes[0][0:2], obs.loc) < self.settings.max_range and
             not line_intersects_grid(obs.loc, obs.foes[0][0:2], self.grid, self.settings.tilesize)):
-            self.goal = obs.foes[0][0:2]
+            # Numpy observations are overwritten every step, keep a copy
+            self.goal = tuple(obs.foes[0][0:2])
             shoot = True
 
         # Compute path, angle and drive
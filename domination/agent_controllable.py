@@ -70,17 +70,17 @@ class Agent(object):
                     self.goals = [(x,y)]
         
         # Pick a "target"
-        target = obs.foes[0] if obs.foes else None
+        target = obs.foes[0] if len(obs.foes) > 0 else None
         
         # Rotate towards target
-        if target and not self.goals:
+        if target is not None and not self.goals:
             dx = target[0]-obs.loc[0]
             dy = target[1]-obs.loc[1]
             turn = angle_fix(math.atan2(dy, dx) - obs.angle)
         
         # Shoot target
         if (obs.ammo > 0 and 
-            target and 
+            target is not None and 
             point_dist(target[0:2], obs.loc) <= self.settings.max_range + 6 and
             not line_intersects_grid(obs.loc, target[0:2], self.grid, self.settings.tilesize)):
             dx = target[0]-obs.loc[0]
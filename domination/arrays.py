@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+""" NumPy observations for domination game engine.
+
+This module fills the observations of a team's tanks into preallocated NumPy
+arrays, so that learning agents don't have to convert lists of tuples to arrays
+in every call to observe(). You need numpy to use it, the game runs fine
+without it. Enable it with ``Settings(observation_type='numpy')``.
+
+Each tank's :class:`~domination.core.Observation` then holds read-only views
+into the arrays of its team:
+
+    ``obs.loc``      int array of shape (2,)
+    ``obs.walls``    int8 array of shape (n, n)
+    ``obs.friends``  int array of shape (visible friends, 2)
+    ``obs.foes``     float array of shape (visible foes, 3), with x, y, angle
+    ``obs.cps``      int array of shape (control points, 3), with x, y, team
+
+The other fields are unchanged. ``obs.arrays`` is the
+:class:`ObservationArrays` of the team, which has the same fields stacked for
+all of its tanks, with row ``i`` belonging to the agent with id ``i``. The
+arrays are overwritten in place every step, so copy whatever you want to keep.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Libraries
+import numpy as np
+
+### CLASSES ###
+
+class ObservationArrays(object):
+    """ Stacked observation buffers for all tanks of one team.
+
+        Friends and foes are padded with zeros beyond the number that
+        each tank sees, which is kept in num_friends and num_foes.
+    """
+
+    def __init__(self, game, tanks, out=None):
+        """ Sets up the arrays and points the tanks' observations at them.
+            Pass a dict of arrays as out to fill those instead of new ones,
+            they must have the shapes of the arrays below.
+        """
+        settings = game.settings
+        field = game.field
+        n = len(tanks)
+        others = len(game.tanks) - n
+        self.gridrng = gridrng = int((settings.max_see/2+1)//field.tilesize)
+        size = gridrng * 2 + 1
+        out = out or {}
+        
+        def array(name, shape, dtype):
+            if name not in out:
+                return np.zeros(shape, dtype=dtype)
+            a = out[name]
+            if a.shape != shape:
+                raise Exception("Array %s should have shape %s, not %s" % (name, shape, a.shape))
+            a[...] = 0
+            return a
+            
+        self.padded      = np.array(field.padded_wallgrid(gridrng), dtype=np.int8)
+        self.loc         = array('loc', (n, 2), int)
+        self.angle       = array('angle', (n,), float)
+        self.ammo        = array('ammo', (n,), int)
+        self.walls       = array('walls', (n, size, size), np.int8)
+        self.friends     = array('friends', (n, max(n - 1, 0), 2), int)
+        self.num_friends = array('num_friends', (n,), int)
+        self.foes        = array('foes', (n, others, 3), float)
+        self.num_foes    = array('num_foes', (n,), int)
+        self.cps         = array('cps', (len(game.controlpoints), 3), int)
+        # Read-only views for the agents
+        self._cps = self._readonly(self.cps)
+        self._views = {}
+        for tank in tanks:
+            i = tank.id
+            self._views[i] = tuple(self._readonly(a[i]) for a in
+                                   (self.loc, self.walls, self.friends, self.foes))
+            tank.arrays = self
+            obs = tank.observation
+            obs.arrays  = self
+            obs.loc     = self._views[i][0]
+            obs.walls   = self._views[i][1]
+            obs.friends = self._views[i][2][:0]
+            obs.foes    = self._views[i][3][:0]
+            obs.cps     = self._cps
+
+    def _readonly(self, a):
+        view = a.view()
+        view.flags.writeable = False
+        return view
+
+    def set_cps(self, cps):
+        """ Copies the (x, y, team) tuples of the control points. """
+        if cps:
+            self.cps[:] = cps
+
+    def set_walls(self, tank, xj, yi):
+        """ Copies the walls around the given tile into the tank's window. """
+        window = self.walls[tank.id]
+        padded = self.padded
+        n = window.shape[0]
+        h, w = padded.shape
+        # The tile is at the center of the window, which starts at row yi
+        # and column xj of the padded grid. Outside of that grid are walls.
+        if 0 <= yi and yi + n <= h and 0 <= xj and xj + n <= w:
+            window[:] = padded[yi:yi + n, xj:xj + n]
+        else:
+            window[:] = 1
+            i0, i1 = max(yi, 0), min(yi + n, h)
+            j0, j1 = max(xj, 0), min(xj + n, w)
+            if i0 < i1 and j0 < j1:
+                window[i0 - yi:i1 - yi, j0 - xj:j1 - xj] = padded[i0:i1, j0:j1]
+
+    def set_state(self, tank):
+        """ Copies the tank's location, angle and ammo into its row, and
+            points its observation at the arrays.
+        """
+        i = tank.id
+        obs = tank.observation
+        self.loc[i] = obs.loc
+        self.angle[i] = obs.angle
+        self.ammo[i] = obs.ammo
+        obs.loc = self._views[i][0]
+        obs.cps = self._cps
+
+    def fill(self, tank, close):
+        """ Fills in the tank's friends and foes from the (object, value) 
+            pairs that it sees, and points its observation at them. Returns 
+            the list of visible objects, which stays a list of tuples.
+        """
+        i = tank.id
+        obs = tank.observation
+        siz = tank.width / 2.0
+        friends, foes = self.friends[i], self.foes[i]
+        nf = ne = 0
+        objects = []
+        for (o, item) in close:
+            if item is None:
+                if o.team == tank.team:
+                    if o is not tank:
+                        friends[nf] = (int(o._x+siz), int(o._y+siz))
+                        nf += 1
+                else:
+                    foes[ne] = (int(o._x+siz), int(o._y+siz), o._a)
+                    ne += 1
+            else:
+                objects.append(item)
+        friends[nf:] = 0
+        foes[ne:] = 0
+        self.num_friends[i] = nf
+        self.num_foes[i] = ne
+        views = self._views[i]
+        obs.friends = views[2][:nf]
+        obs.foes = views[3][:ne]
+        return objects
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+""" Domination game engine for Reinforcement Learning research.
+
+Micro-benchmarks for the game engine. Run with::
+
+    python -m domination.benchmark
+
+"""
+
+### IMPORTS ###
+# Python
+import sys
+import time
+import random
+import tracemalloc
+
+# Local
+from . import core
+
+### CONSTANTS ###
+
+SITTING_AGENT = """
+class Agent(object):
+    NAME = "sittingagent"
+    
+    def __init__(self, id, team, *args, **kwargs):
+        self.id = id
+    
+    def observe(self, observation):
+        self.observation = observation
+    
+    def action(self):
+        # Drive to a control point and stand still on it
+        obs = self.observation
+        (x, y, _) = obs.cps[self.id % len(obs.cps)]
+        (dx, dy) = (x - obs.loc[0], y - obs.loc[1])
+        if dx*dx + dy*dy < 25*25:
+            return (0, 0, False)
+        return (angle_fix(math.atan2(dy, dx) - obs.angle), 40, False)
+    
+    def debug(self, surface):
+        pass
+    
+    def finalize(self, interrupted=False):
+        pass
+"""
+
+### CLASSES ###
+
+class PlainObject(object):
+    """ Stand-in for a game object that keeps its attributes
+        in a __dict__, like the game objects did before they
+        used __slots__.
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class ResortingBroadphase(core.SweepAndPrune):
+    """ Stand-in for the broadphase that sorts all objects again
+        on every update, like the solver did before it kept them
+        in order between substeps.
+    """
+    def update(self):
+        self.objects.sort(key=lambda o: o._x)
+
+### FUNCTIONS ###
+
+def slot_attributes(o):
+    """ Returns a dict with the values of all slots that are set on o. """
+    attributes = {}
+    for cls in type(o).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(o, name):
+                attributes[name] = getattr(o, name)
+    return attributes
+
+def as_plain(o):
+    """ Returns a PlainObject with the same attributes as the given object. """
+    return PlainObject(**slot_attributes(o))
+
+def memory(num=10000):
+    """ Measures the memory used by num crumbs, as slotted objects and
+        as objects with a __dict__. Returns bytes per object for both.
+    """
+    template = slot_attributes(core.Crumb(0, 0))
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    slotted = [core.Crumb(i, i) for i in range(num)]
+    used_slotted = tracemalloc.get_traced_memory()[0] - start
+    del slotted
+    start = tracemalloc.get_traced_memory()[0]
+    plain = [PlainObject(**template) for i in range(num)]
+    used_plain = tracemalloc.get_traced_memory()[0] - start
+    del plain
+    tracemalloc.stop()
+    return used_slotted / float(num), used_plain / float(num)
+
+def separation_speed(num=2000, repeat=5):
+    """ Times Game._compute_separation plus the bounding box tests that
+        precede it in the physics loop, on random pairs of tanks and walls.
+        Returns the best time in seconds for slotted and plain objects.
+    """
+    rng = random.Random(0)
+    pairs = []
+    for _ in range(num):
+        tank = core.Tank(x=rng.uniform(0, 40), y=rng.uniform(0, 40))
+        if rng.random() < 0.5:
+            other = core.Tank(x=rng.uniform(0, 40), y=rng.uniform(0, 40))
+        else:
+            other = core.Wall(x=rng.uniform(0, 40), y=rng.uniform(0, 40), width=16, height=16)
+        pairs.append((tank, other))
+    plain_pairs = [(as_plain(a), as_plain(b)) for (a, b) in pairs]
+    separate = core.Game._compute_separation
+    def run(pairs):
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for (o1, o2) in pairs:
+                if (o2._x < (o1._x + o1.width) and o1._x < (o2._x + o2.width) and
+                    o2._y < (o1._y + o1.height) and o1._y < (o2._y + o2.height)):
+                    separate(None, o1, o2)
+            best = min(best, time.perf_counter() - t0)
+        return best
+    return run(pairs), run(plain_pairs)
+
+def nav_mesh_speed(sizes=((41, 24), (81, 48), (121, 72), (150, 100))):
+    """ Times unpacking a generated field of each of the given sizes (in
+        tiles) and building its nav mesh. Returns a list of (size, nodes, 
+        seconds).
+    """
+    results = []
+    for (width, height) in sizes:
+        field = core.FieldGenerator(width=width, height=height).generate(seed=0)
+        t0 = time.perf_counter()
+        mesh = field.mesh
+        results.append(((width, height), len(mesh), time.perf_counter() - t0))
+    return results
+
+def physics_speed(games=3, steps=150):
+    """ Plays games between the default agents on default fields, and
+        returns the time spent in the physics, in seconds per game, with 
+        the SweepAndPrune broadphase and with a ResortingBroadphase.
+    """
+    results = []
+    for broadphase in (core.SweepAndPrune, ResortingBroadphase):
+        total = 0.0
+        for seed in range(games):
+            field = core.FieldGenerator().generate(seed=seed)
+            game = core.Game(settings=core.Settings(max_steps=steps), field=field,
+                             rendered=False, verbose=False, seed=seed)
+            game._setup()
+            stand_in = broadphase()
+            stand_in.objects = game.broadphase_mov.objects
+            game.broadphase_mov = stand_in
+            game.run()
+            total += game.sim_time_total
+        results.append(total / games)
+    return results
+
+def sleep_speed(games=3, steps=300):
+    """ Plays games in which the tanks drive to a control point and stand
+        still on it. Returns the time spent in the physics, in seconds per
+        game, with and without letting the tanks that stand still sleep.
+    """
+    results = []
+    for sleep in (True, False):
+        core.Game.SIMULATION_SLEEP = sleep
+        total = 0.0
+        for seed in range(games):
+            field = core.FieldGenerator(num_points=3).generate(seed=seed)
+            game = core.Game(SITTING_AGENT, SITTING_AGENT, settings=core.Settings(max_steps=steps), 
+                             field=field, rendered=False, verbose=False, seed=seed)
+            game.run()
+            total += game.sim_time_total
+        results.append(total / games)
+    core.Game.SIMULATION_SLEEP = True
+    return results
+
+def setup_speed(num=50):
+    """ Times Game.reset on a field with and a field without crumbs, each
+        game with its own seed. Returns a list of (name, seconds per reset 
+        when the field's objects are reused, and when they are created anew).
+    """
+    results = []
+    fields = (('default', core.FieldGenerator().generate(seed=0)),
+              ('crumbs', core.FieldGenerator(num_crumbsource=2).generate(seed=0)))
+    for (name, field) in fields:
+        times = []
+        for reuse in (True, False):
+            game = core.Game(field=field, rendered=False, verbose=False)
+            game.reset()
+            t0 = time.perf_counter()
+            for i in range(num):
+                game.seed = i
+                if not reuse:
+                    game._statics = None
+                game.reset()
+            times.append((time.perf_counter() - t0) / num)
+        results.append((name, times[0], times[1]))
+    return results
+
+def main():
+    slotted, plain = memory()
+    print("Memory per Crumb:       %6.0f bytes (slots), %6.0f bytes (__dict__)" % (slotted, plain))
+    slotted, plain = separation_speed()
+    print("Separating 2000 pairs:  %6.2f ms (slots),    %6.2f ms (__dict__)" % (slotted * 1000, plain * 1000))
+    for ((width, height), nodes, seconds) in nav_mesh_speed():
+        print("Nav mesh %3dx%-3d:       %6.2f s (%d nodes)" % (width, height, seconds, nodes))
+    in_order, resorted = physics_speed()
+    print("Physics, default field: %6.2f s (in order),  %6.2f s (re-sorted)" % (in_order, resorted))
+    sleeping, awake = sleep_speed()
+    print("Physics, standing still: %5.2f s (sleeping),  %6.2f s (awake)" % (sleeping, awake))
+    for (name, reused, new) in setup_speed():
+        print("Reset %-8s field:    %6.2f ms (reused),   %6.2f ms (new)" % (name, reused * 1000, new * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,7 @@ import hashlib
 import logging
 from pprint import pprint
 import pickle as pickle
+import json
 try:
     import numpy
 except ImportError:
@@ -62,11 +63,16 @@ ENDGAME_NONE   = 0 #: End game when time expires
 ENDGAME_SCORE  = 1 #: End game when either team has 0 score
 ENDGAME_CRUMBS = 2 #: End game when all crumbs are picked up
 
+PHASES = ('update', 'observe', 'act', 'shoot', 'substep', 'render') #: The phases of a game step that are timed
+
 DEFAULT_AGENT_FILE = os.path.join(os.path.dirname(__file__), 'agent.py')
 ILLEGAL_PATH_CHARS = r'[:*?"<>\|\n]+'
 
 AGENT_GLOBALS = globals().copy()
 
+# Compiled agent code, by the sha1 of its source. Shared by all games in this process.
+COMPILED_BRAINS = {}
+
 ### CLASSES ###
 
 class Settings(object):
@@ -84,7 +90,9 @@ class Settings(object):
                        tilesize=16,
                        think_time=0.010,
                        capture_mode=CAPTURE_MODE_MAJORITY,
-                       end_condition=ENDGAME_SCORE):
+                       end_condition=ENDGAME_SCORE,
+                       observation_type='python',
+                       lazy_observations=False):
         """ Constructor for Settings class
         
             :param max_steps:     How long the game will last at most
@@ -102,6 +110,10 @@ class Settings(object):
             :param capture_mode:  One of the CAPTURE_MODE constants.
             :param end_condition: One of the ENDGAME flags. Use bitwise OR for multiple.
             :param tilesize:      How big a single tile is (game units), change at risk of massive bugginess
+            :param observation_type: What agents observe, 'python' lists and tuples, or 'numpy' arrays
+                                     (requires numpy, see :mod:`domination.arrays`)
+            :param lazy_observations: Only compute the objects and walls that agents see when they 
+                                      read them, see :class:`~domination.core.LazyObservation`
         """            
         self.max_steps     = max_steps    
         self.max_score     = max_score    
@@ -118,9 +130,20 @@ class Settings(object):
         self.capture_mode  = capture_mode 
         self.end_condition = end_condition
         self.tilesize      = tilesize     
+        self.observation_type = observation_type
+        self.lazy_observations = lazy_observations
         # Validate
         if max_score % 2 != 0:
             raise Exception("Max score (%d) has to be even."%max_score)
+        if observation_type not in ('python', 'numpy'):
+            raise Exception("Unknown observation type '%s'"%observation_type)
+        
+    def __setstate__(self, state):
+        """ Settings pickled by older versions (e.g. in replays) get
+            the defaults for the settings that were added since.
+        """
+        self.__dict__.update(Settings().__dict__)
+        self.__dict__.update(state)
         
     def __repr__(self):
         default = Settings()
@@ -128,6 +151,47 @@ class Settings(object):
         args = ', '.join(args)
         return 'Settings(%s)'%args
                 
+class LatencyHistogram(object):
+    """ Counts durations in buckets that are about 5% wide, so that
+        percentiles can be computed without keeping every duration.
+    """
+    RESOLUTION = 20 # Buckets per factor e
+    
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count   = 0 #: Number of durations
+        self.total   = 0 #: Sum of the durations in nanoseconds
+        self.max     = 0 #: Longest duration in nanoseconds
+        
+    def add(self, ns):
+        """ Adds a duration in nanoseconds. """
+        self.buckets[int(math.log(ns) * self.RESOLUTION) if ns > 1 else 0] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+            
+    def percentile(self, p):
+        """ Returns the duration in seconds that p percent of the
+            durations are shorter than, to within the bucket width.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                break
+        return min(math.exp((b + 0.5) / self.RESOLUTION), self.max) * 1e-9
+        
+    def mean(self):
+        """ Returns the mean duration in seconds. """
+        return self.total * 1e-9 / self.count if self.count else 0.0
+        
+    def __repr__(self):
+        return "p50 %.3fms p99 %.3fms"%(self.percentile(50) * 1000, self.percentile(99) * 1000)
+        
 class GameStats(object):
     def __init__(self):
         self.score_red       = 0  #:The number of points scored by red
@@ -140,9 +204,16 @@ class GameStats(object):
         self.deaths_blue     = 0 #: Number blue agents that got shot
         self.think_time_red  = 0.0 #: Total time in seconds that red took to compute actions
         self.think_time_blue = 0.0 #: Idem for blue
+        self.observations    = 0 #: Number of observations sent to agents
+        self.observed_objects = 0 #: Number of times that the friends, foes and objects of an observation were computed
+        self.observed_walls  = 0 #: Number of times that the walls of an observation were computed
+        self.phase_time      = dict((phase, 0.0) for phase in PHASES) #: Total time in seconds spent in each of the PHASES of the steps
+        self.latency         = {} #: For each (team, id) of an agent, a dict with a :class:`LatencyHistogram` of its 'observe', 'action' and 'think' (both) times
     
     def __str__(self):
-        items = sorted(self.__dict__.items())
+        items = sorted((k, v) for (k, v) in self.__dict__.items() if k != 'latency')
+        items.extend(('think %s-%d'%('RED' if team == TEAM_RED else 'BLU', i), h['think']) 
+                     for ((team, i), h) in sorted(self.latency.items()) if h['think'].count)
         maxlen = max(len(k) for k,v in items)
         return "== GAME STATS ==\n" + "\n".join(('%s : %r'%(k.ljust(maxlen), v)) for (k,v) in items)
         
@@ -178,11 +249,14 @@ class Team(object):
     FIND_NAME   = r'^[ \t]*NAME[ \t]*=[ \t]*[\'\"]([a-zA-Z0-9\-\_ ]{3,20})[\'\"]'
     NAME_UNSAFE = r'[^a-zA-Z0-9\_]+'
     
-    def __init__(self, brain=None, init_kwargs={}, name=None):
+    def __init__(self, brain=None, init_kwargs={}, name=None, reuse_namespace=False):
         """ Initialize a Team object.
         
             :param brain: A path to the brain, or a string containing it, or an
                             open file pointer.
+            :param reuse_namespace: Run the brain's module code only in the first
+                            game, and keep its namespace for the next games that
+                            this team plays. Module level state is kept as well.
         """
         # Do some heuristics to find out how to get the agent:
         if brain is None:
@@ -201,6 +275,9 @@ class Team(object):
                 self.name_external = name
         self.init_kwargs = init_kwargs
         self.brain_class = None
+        self.batched = False
+        self.reuse_namespace = reuse_namespace
+        self.namespace = None
         # Fetch the NAME from the agent code
         match = re.search(self.FIND_NAME, self.brain_string, re.M)
         if match:
@@ -226,9 +303,25 @@ class Team(object):
             return self.name_internal + ' (' + self.name_external + ')'
         
     def load(self, scope):
-        """ Load up the brain from the string 
+        """ Load up the brain from the string. If it defines a TeamBrain
+            that is used for the whole team, instead of an Agent per tank.
+            The compiled code is cached for all games in this process.
         """
-        exec(self.brain_string, scope)
+        self.batched = False
+        if self.reuse_namespace and self.namespace is not None:
+            # Keep the namespace, but draw from the rand() of this game
+            self.namespace['rand'] = scope['rand']
+            scope = self.namespace
+        else:
+            key = hashlib.sha1(self.brain_string.encode('utf-8')).hexdigest()
+            if key not in COMPILED_BRAINS:
+                COMPILED_BRAINS[key] = compile(self.brain_string, '<string>', 'exec')
+            exec(COMPILED_BRAINS[key], scope)
+            if self.reuse_namespace:
+                self.namespace = scope
+        if 'TeamBrain' in scope:
+            self.batched = True
+            return scope['TeamBrain']
         return scope['Agent']
         
 class AgentStub(object):
@@ -245,6 +338,227 @@ class AgentStub(object):
         
     def debug(self, surface): pass
             
+class TeamBrain(object):
+    """ Brains can be written for a whole team instead of per tank, by
+        defining a TeamBrain class instead of an Agent class. It is
+        constructed once per team with the number of agents, and gets
+        all observations and returns all actions in a single call.
+        This is the interface, and also the stub that is used when it
+        can't be constructed.
+    """
+    def __init__(self, num_agents, team, settings=None, **kwargs):
+        self.num_agents = num_agents
+    
+    def observe(self, observations):
+        """ Gets a list of observations, one per agent, ordered by id. """
+        pass
+        
+    def action(self):
+        """ Returns a list of (turn, speed, shoot) tuples, one per agent. """
+        return [(0,0,False)] * self.num_agents
+    
+    def finalize(self, interrupted=False): pass
+        
+    def debug(self, surface): pass
+
+class SweepAndPrune(object):
+    """ Persistent sort-and-sweep broadphase along the x-axis.
+    
+        The objects are kept in order of their _x across calls. Because they 
+        barely move between calls, restoring that order with insertion sort 
+        takes close to linear time, instead of sorting everything again. The
+        pairs whose x-intervals overlap are then found by sweeping over the 
+        objects, each object only looks ahead until the first one that 
+        starts beyond its right edge.
+    """
+    def __init__(self):
+        self.objects = []  #: All objects, sorted by their _x
+    
+    def __iter__(self):
+        return iter(self.objects)
+    
+    def __len__(self):
+        return len(self.objects)
+        
+    def add(self, o):
+        """ Adds an object, behind all objects with the same _x. """
+        self.objects.append(o)
+        self.update()
+        
+    def remove(self, o):
+        """ Removes an object. """
+        self.objects.remove(o)
+        
+    def update(self):
+        """ Restores the order after objects have moved, with a 
+            stable insertion sort on their _x.
+        """
+        objs = self.objects
+        for i in range(1, len(objs)):
+            o = objs[i]
+            x = o._x
+            if objs[i-1]._x > x:
+                j = i
+                while j > 0 and objs[j-1]._x > x:
+                    objs[j] = objs[j-1]
+                    j -= 1
+                objs[j] = o
+                
+    def overlaps(self):
+        """ Returns the (i, j) indices of the objects whose x-intervals
+            overlap, with i < j, ordered on i and then on j.
+        """
+        objs = self.objects
+        n = len(objs)
+        found = []
+        for i in range(n):
+            r = objs[i]._x + objs[i].width
+            j = i + 1
+            while j < n and objs[j]._x < r:
+                found.append((i, j))
+                j += 1
+        return found
+            
+class StaticGrid(object):
+    """ Spatial hash for objects that don't move, bucketed on the field's tiles.
+    
+        Every object is stored in all tiles that its bounding box touches, so
+        a query only has to look at the tiles around the queried area instead
+        of at every static object in the same x-band. Anything outside of the
+        field is kept in the nearest tile on the border. Iterating over the 
+        grid itself yields the objects sorted by their _x.
+    """
+    def __init__(self, width, height, tilesize):
+        self.width    = width
+        self.height   = height
+        self.tilesize = tilesize
+        self.objects  = []  #: All objects, sorted by their _x
+        self.keys     = []  # Sort keys (_x, seq) of the objects
+        # For each tile, a dict of seq -> (_x, seq, object)
+        self.cells    = [[{} for _ in range(width)] for _ in range(height)]
+        self.seqs     = {}  # Maps id(object) to its sequence number
+        self.seq      = 0
+        self.cache    = {}  # Maps a range of tiles to the query result
+    
+    def __iter__(self):
+        return iter(self.objects)
+    
+    def __len__(self):
+        return len(self.objects)
+    
+    def _span(self, lo, hi, n):
+        """ Returns the range of tile indices covering lo to hi. """
+        ts = self.tilesize
+        return (min(max(int(lo // ts), 0), n - 1), 
+                min(max(int(hi // ts), 0), n - 1) + 1)
+    
+    def _tiles(self, o):
+        imin, imax = self._span(o._y, o._y + o.height, self.height)
+        jmin, jmax = self._span(o._x, o._x + o.width, self.width)
+        return [row[jmin:jmax] for row in self.cells[imin:imax]]
+    
+    def add(self, o, seq=None):
+        """ Adds an object, behind all objects with the same _x. An object 
+            that is put back can be given its old sequence number, to take
+            its old place among them.
+        """
+        if seq is None:
+            seq = self.seq
+            self.seq += 1
+        key = (o._x, seq)
+        self.seqs[id(o)] = seq
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.objects.insert(i, o)
+        entry = key + (o,)
+        self.cache = {}
+        for row in self._tiles(o):
+            for cell in row:
+                cell[key[1]] = entry
+    
+    def remove(self, o):
+        """ Removes an object from the list and from all its tiles. """
+        key = (o._x, self.seqs.pop(id(o)))
+        i = bisect.bisect_left(self.keys, key)
+        del self.keys[i]
+        del self.objects[i]
+        self.cache = {}
+        for row in self._tiles(o):
+            for cell in row:
+                del cell[key[1]]
+    
+    def query(self, xmin, xmax, ymin, ymax):
+        """ Returns the (_x, seq, object) entries in the tiles that overlap the
+            given bounds, sorted by _x. These are candidates, the caller still 
+            has to check if their bounding boxes actually intersect. Results
+            are cached until the next object is added or removed.
+        """
+        ts, w, h = self.tilesize, self.width - 1, self.height - 1
+        imin, imax = int(ymin // ts), int(ymax // ts)
+        jmin, jmax = int(xmin // ts), int(xmax // ts)
+        imin = 0 if imin < 0 else h if imin > h else imin
+        imax = 0 if imax < 0 else h if imax > h else imax
+        jmin = 0 if jmin < 0 else w if jmin > w else jmin
+        jmax = 0 if jmax < 0 else w if jmax > w else jmax
+        key = (imin, imax, jmin, jmax)
+        entries = self.cache.get(key)
+        if entries is None:
+            found = {}
+            for row in self.cells[imin:imax+1]:
+                for cell in row[jmin:jmax+1]:
+                    found.update(cell)
+            entries = self.cache[key] = sorted(found.values())
+        return entries
+
+class VisionGrid(object):
+    """ Buckets the objects that tanks can see on a coarse grid.
+    
+        The grid is rebuilt once per step, and its cells are as large as 
+        the area that a tank sees, so that a query only has to look at the 
+        few cells around it, instead of at every object on the field. Each 
+        object is stored in the cell of its top-left corner, along with a
+        value that is handed back with it.
+    """
+    def __init__(self, cellsize):
+        self.cellsize = float(cellsize)
+        self.cells    = {}  # Maps (i, j) to a list of (rank, object, value)
+        self.maxsize  = 0.0 # The largest width or height of any object
+    
+    def build(self, items):
+        """ Replaces the contents of the grid with the given (object, value)
+            pairs. Queries return the objects in this same order.
+        """
+        cs = self.cellsize
+        cells = self.cells = {}
+        maxsize = 0.0
+        for rank, (o, value) in enumerate(items):
+            key = (int(o._y // cs), int(o._x // cs))
+            if key in cells:
+                cells[key].append((rank, o, value))
+            else:
+                cells[key] = [(rank, o, value)]
+            maxsize = max(maxsize, o.width, o.height)
+        self.maxsize = maxsize
+    
+    def query(self, xmin, xmax, ymin, ymax):
+        """ Returns the (object, value) pairs of all objects whose bounding 
+            boxes intersect the given bounds.
+        """
+        cs, m = self.cellsize, self.maxsize
+        cells = self.cells
+        found = []
+        for i in range(int((ymin - m) // cs), int(ymax // cs) + 1):
+            for j in range(int((xmin - m) // cs), int(xmax // cs) + 1):
+                cell = cells.get((i, j))
+                if cell is not None:
+                    for entry in cell:
+                        o = entry[1]
+                        if (o._x <= xmax and o._x + o.width > xmin and
+                            ymin < (o._y + o.height) and o._y < ymax):
+                            found.append(entry)
+        found.sort()
+        return [(o, value) for (_, o, value) in found]
+
 class Game(object):
     
     """ The main game class. Contains game data and methods for
@@ -253,6 +567,8 @@ class Game(object):
     
     SIMULATION_SUBSTEPS = 10
     SIMULATION_MAXITER  = 20
+    SIMULATION_EPSILON  = 0.001
+    SIMULATION_SLEEP    = True  # Let objects that stand still skip the collision checks
     
     STATE_NEW       = 0
     STATE_READY     = 1
@@ -271,7 +587,10 @@ class Game(object):
                        rendered=True, 
                        verbose=True,
                        hard_errors=False,
-                       step_callback=None):
+                       step_callback=None,
+                       physics='python',
+                       workers=False,
+                       seed=None):
         """ Constructor for Game class 
             
             :param red:               Descriptor of the red agent.
@@ -289,11 +608,17 @@ class Game(object):
             :param verbose:           Print game log to output.
             :param hard_errors:       Enable to make agent errors interrupt the game.
             :param step_callback:     Function that is called on every step. Useful for debugging.
+            :param physics:           The collision solver to use, 'python' or 'numpy' (requires numpy).
+            :param workers:           Run each team's agents in a worker process, see :mod:`~domination.workers`.
+            :param seed:              Seed for the random numbers of the game, and for the ``rand``
+                                        function of the agents, to play the same game again.
         """
         self.record = record
         self.verbose = verbose
         self.step_callback = step_callback
         self.hard_errors = hard_errors
+        self.use_workers = workers
+        self.seed = seed
         
         # Public properties
         self.log    = GameLog(self.verbose) #: The game log as an instance of class:`~domination.core.GameLog`
@@ -320,6 +645,7 @@ class Game(object):
                 print(("WARNING: Replay is for version %s, you have %s."%(replay.version, __version__)), file=sys.stderr)
             self.settings = replay.settings
             self.field = replay.field
+            self.seed = getattr(replay, 'seed', None)
             self.red.setname(replay.red_name)
             self.blue.setname(replay.blue_name)
 
@@ -329,8 +655,22 @@ class Game(object):
         else:
             self.renderer = None
         
+        self.set_physics(physics)
+        
+        self.static_version = 0
+        self._statics = None  # The static objects at the start of the last game, see _add_statics
         self.state = Game.STATE_NEW
         
+    def _agent_scope(self):
+        """ Returns the globals for the agents of a team. With a seed, their
+            rand() draws from a generator of their own, seeded with it, and
+            the global random module is left alone.
+        """
+        scope = AGENT_GLOBALS.copy()
+        if self.seed is not None:
+            scope['rand'] = random.Random(self.seed).random
+        return scope
+        
     def _agent_call(self, method, args=[], kwargs={}, team=TEAM_NEUTRAL, default=None):
         """ Calls a method on an agent, wrapping it in a try/catch block
             to prevent agents from crashing the game.
@@ -350,15 +690,74 @@ class Game(object):
                 traceback.print_exc(file=sys.stdout)
                 print('-' * 60)
                 return default
-            
+
+    def _team_think(self, brain, tanks):
+        """ Gives all observations of a team to its TeamBrain in one call,
+            and hands the actions that it returns out to the tanks. The
+            team may think as long as all of its agents together.
+        """
+        team = tanks[0].team
+        noop = [(0,0,False)] * len(tanks)
+        last_clock = time.perf_counter_ns()
+        self._agent_call(brain.observe, args=[[t.observation for t in tanks]], team=team)
+        observe_ns = time.perf_counter_ns() - last_clock
+
+        def _act():
+            actions = list(brain.action())
+            if len(actions) != len(tanks) or any(a is None or len(a) != 3 for a in actions):
+                raise Exception("Actions should be a list of 3-tuples of (turn, speed, shoot), one per agent")
+            return actions
+
+        actions = self._agent_call(_act, default=noop, team=team)
+        action_ns = time.perf_counter_ns() - last_clock - observe_ns
+        time_thought = (observe_ns + action_ns) * 1e-9
+        # Ignore actions (NO-OP) if the team thought too long.
+        if time_thought > self.settings.think_time * len(tanks):
+            actions = noop
+            print('[Game]: Team %s timed out (%.3fs).'%('RED' if team == TEAM_RED else 'BLU', time_thought))
+        for (tank, action) in zip(tanks, actions):
+            tank.team_action = tuple(action)
+            tank.time_thought = time_thought / len(tanks)
+            tank.observe_ns = observe_ns // len(tanks)
+            tank.action_ns = action_ns // len(tanks)
+        if self.renderer is not None and self.renderer.active_team == team:
+            brain.debug(self.renderer.agent_debug)
+
+    def _workers_think(self):
+        """ Sends the observations to the worker processes, so that both
+            teams think at the same time, and collects their actions. The
+            game waits for each team at most as long as its think time.
+        """
+        start = time.monotonic()
+        for worker in self.workers:
+            worker.send(self.step)
+        for worker in self.workers:
+            worker.collect(self.step, start + self.settings.think_time * len(worker.tanks))
+
     def add_renderer(self, **kwargs):
         from . import renderer
         globals()['renderer'] = renderer
         self.renderer = renderer.Renderer(self, **kwargs)
         
-    def _setup(self):
-        """ Sets up the game.
+    def set_physics(self, engine='python'):
+        """ Selects the collision solver, either the builtin 'python'
+            solver, or the vectorized 'numpy' solver.
+        """
+        if engine == 'python':
+            self.physics = None
+        elif engine == 'numpy':
+            from . import physics
+            self.physics = physics.NumpyPhysics(self)
+        else:
+            raise Exception("Unknown physics engine '%s'"%engine)
+        
+    def _setup(self, brains=True):
+        """ Sets up the game. Without brains, the tanks do
+            the team_action that is set from outside.
         """
+        # Each game has its own log
+        if self.state != Game.STATE_NEW:
+            self.log = GameLog(self.verbose)
         # Redirect STDOUT
         self.old_stdout = sys.stdout
         sys.stdout = self.log
@@ -369,17 +768,12 @@ class Game(object):
         print("Playing `%s` vs. `%s`"%(self.red.fullname(), self.blue.fullname()))
         
         self.random = random.Random()
-        self.random.seed(RANDOMSEED)
+        self.random.seed(RANDOMSEED if self.seed is None else self.seed)
         # Initialize new replay
         if self.record:
             self.replay = ReplayData(self)
             self.replay.red_name = self.red.fullname()
             self.replay.blue_name = self.blue.fullname()
-        # Load field objects
-        allobjects = self.field.get_objects()
-        cps = [o for o in allobjects if isinstance(o, ControlPoint)]
-        reds = [o for o in allobjects if isinstance(o, TankSpawn) and o.team == TEAM_RED]
-        blues = [o for o in allobjects if isinstance(o, TankSpawn) and o.team == TEAM_BLUE]
         # Game logic variables
         self.score_red   = self.settings.max_score / 2
         self.score_blue  = self.settings.max_score / 2
@@ -387,10 +781,11 @@ class Game(object):
         self.interrupted = False
         self.keys        = []
         # Simulation variables
-        self.object_uid    = 0
-        self.objects         = []
-        self.broadphase_mov  = []
-        self.broadphase_stat = []
+        self.contacts      = {}
+        self.collision_handlers = {}
+        self.broadphase_mov  = SweepAndPrune()
+        self.vision          = VisionGrid(self.settings.max_see * 2 + Tank.SIZE_VACUBOT)
+        self.visible_cps     = ()
         # Performance tracking
         self.stats = GameStats()
         self.think_time_red        = 0.0
@@ -398,37 +793,58 @@ class Game(object):
         self.update_time_total     = 0.0
         self.sim_time              = 0.0
         self.sim_time_total        = 0.0
+        self.phase_ns              = dict((phase, 0) for phase in PHASES)
         # Game objects
-        self.tanks         = []
-        self.controlpoints = []
-        for o in allobjects:
-            self._add_object(o)
-        self.controlpoints = cps
+        self.tanks = []
+        allobjects = self._add_statics()
+        self.controlpoints = [o for o in allobjects if isinstance(o, ControlPoint)]
+        self.fountains = [o for o in allobjects if isinstance(o, Fountain)]
+        reds = [o for o in allobjects if isinstance(o, TankSpawn) and o.team == TEAM_RED]
+        blues = [o for o in allobjects if isinstance(o, TankSpawn) and o.team == TEAM_BLUE]
         # Initialize tanks
         print("Initializing agents.")
-        if self.record or self.replay is None:
+        team_brains = {}
+        new_tanks = self.record or self.replay is None
+        if new_tanks and (self.use_workers or not brains):
+            # Initialize new tanks, their brains are in the worker processes (if any)
+            for (team, spawns) in ((TEAM_RED, reds), (TEAM_BLUE, blues)):
+                for i,s in enumerate(spawns):
+                    t = Tank(s.x+2, s.y+2, s.angle, i, team=team, spawn=s, record=self.record)
+                    self.tanks.append(t)
+                    self._add_object(t)
+        elif new_tanks:
             # Initialize new tanks with brains
-            brain_kwargs = {'settings': self.settings}
+            # The field data is read-only and shared by all agents, only settings are copied.
+            brain_kwargs = {}
             if self.settings.field_known:
-                brain_kwargs.update({'field_rects': self.field.wallrects, 
-                                     'field_grid': self.field.wallgrid,
-                                     'nav_mesh': self.field.mesh})
+                (rects, grid, mesh) = self.field.frozen()
+                brain_kwargs.update({'field_rects': rects, 
+                                     'field_grid': grid,
+                                     'nav_mesh': mesh})
             
-            red_brain_class = self._agent_call(self.red.load, kwargs={'scope':AGENT_GLOBALS.copy()}, team=TEAM_RED, default=AgentStub)
-            blue_brain_class = self._agent_call(self.blue.load, kwargs={'scope':AGENT_GLOBALS.copy()}, team=TEAM_BLUE, default=AgentStub)
+            red_brain_class = self._agent_call(self.red.load, kwargs={'scope':self._agent_scope()}, team=TEAM_RED, default=AgentStub)
+            blue_brain_class = self._agent_call(self.blue.load, kwargs={'scope':self._agent_scope()}, team=TEAM_BLUE, default=AgentStub)
             
-            def construct_tanks(brainclass, init_kwargs, team, spawns):
+            def construct_tanks(brainclass, team_obj, team, spawns):
+                if team_obj.batched:
+                    # One brain for all tanks, they don't get their own.
+                    kwargs = dict(brain_kwargs, settings=copy.copy(self.settings))
+                    kwargs.update(team_obj.init_kwargs)
+                    team_brains[team] = self._agent_call(brainclass, args=[len(spawns), team], kwargs=kwargs, 
+                                                         team=team, default=TeamBrain(len(spawns), team))
                 for i,s in enumerate(spawns):
-                    kwargs = copy.deepcopy(brain_kwargs)
-                    kwargs.update(init_kwargs)
-                    brain = self._agent_call(brainclass, args=[i, team], kwargs=kwargs, team=team, default=AgentStub())
+                    brain = None
+                    if not team_obj.batched:
+                        kwargs = dict(brain_kwargs, settings=copy.copy(self.settings))
+                        kwargs.update(team_obj.init_kwargs)
+                        brain = self._agent_call(brainclass, args=[i, team], kwargs=kwargs, team=team, default=AgentStub())
                     t = Tank(s.x+2, s.y+2, s.angle, i, team=team, brain=brain, spawn=s, record=self.record)
                     self.tanks.append(t)
                     self._add_object(t)
                     
-            construct_tanks(red_brain_class, self.red.init_kwargs, TEAM_RED, reds)
+            construct_tanks(red_brain_class, self.red, TEAM_RED, reds)
                 
-            construct_tanks(blue_brain_class, self.blue.init_kwargs, TEAM_BLUE, blues)
+            construct_tanks(blue_brain_class, self.blue, TEAM_BLUE, blues)
             
         else:
             # Initialize tanks to play replays
@@ -442,121 +858,382 @@ class Game(object):
                 self._add_object(t)
         self.tanks_red = [tank for tank in self.tanks if tank.team == TEAM_RED]
         self.tanks_blue = [tank for tank in self.tanks if tank.team == TEAM_BLUE]
+        self.team_brains = []
+        if new_tanks:
+            for (team, tanks) in ((TEAM_RED, self.tanks_red), (TEAM_BLUE, self.tanks_blue)):
+                if team in team_brains:
+                    self.team_brains.append((team_brains[team], tanks))
+        # Set up the arrays for numpy observations
+        self.observation_arrays = []
+        if self.settings.observation_type == 'numpy':
+            from . import arrays
+            self.observation_arrays = [arrays.ObservationArrays(self, self.tanks_red),
+                                       arrays.ObservationArrays(self, self.tanks_blue)]
+        # Start the worker processes, they set up at the same time
+        self.workers = []
+        if new_tanks and self.use_workers and brains:
+            from . import workers
+            self.workers = [workers.TeamWorker(self, self.red, self.tanks_red),
+                            workers.TeamWorker(self, self.blue, self.tanks_blue)]
+            for worker in self.workers:
+                worker.wait_ready()
         self.state = Game.STATE_READY
         self.interrupted = False
         
+    def _add_statics(self):
+        """ Adds the objects of the field, returns them. When the last game
+            was on the same field, with the same settings, its objects and
+            broadphase are reused, they are only put back the way they were
+            at the start of that game, so that only the tanks are new. The
+            children of fountains are put in the spots that a new game with
+            this seed would give them.
+        """
+        settings = dict(self.settings.__dict__)
+        if (self._statics is not None and self._statics[0] is self.field and 
+            self._statics[1] == settings and self._reuse_statics()):
+            return self._statics[2]
+        self.object_uid      = 0
+        self.objects         = []
+        self.broadphase_stat = StaticGrid(self.field.width, self.field.height, 
+                                          self.field.tilesize)
+        self.static_version += 1
+        self.walls_in_range  = None
+        allobjects = self.field.get_objects()
+        for o in allobjects:
+            self._add_object(o)
+        stat = self.broadphase_stat
+        statics = [(o, stat.seqs[id(o)]) for o in stat]
+        children = [(o, list(o.children)) for o in allobjects if isinstance(o, Fountain)]
+        self._statics = (self.field, settings, allobjects, list(self.objects), 
+                         statics, children, self.object_uid, stat.seq)
+        return allobjects
+        
+    def _reuse_statics(self):
+        """ Puts back the objects of the last game, see _add_statics. Returns
+            False, without changing anything, if a fountain would now spawn a 
+            different number of children, then the objects have to be new.
+        """
+        (_, _, allobjects, objects, statics, children, object_uid, seq) = self._statics
+        # Draw the spots in the same order as the fountains of a new game would
+        state = self.random.getstate()
+        spots = []
+        for (fountain, kids) in children:
+            places = [fountain.place() for _ in range(fountain.MIN_CHILDREN)]
+            places = [p for p in places if p is not None]
+            if len(places) != len(kids):
+                self.random.setstate(state)
+                return False
+            spots.extend((o, x, y) for (o, (x, y)) in zip(kids, places) if (x, y) != (o.x, o.y))
+        for (o, x, y) in spots:
+            o.x = o._x = x
+            o.y = o._y = y
+            o.cx = int(x + o.SIZE/2)
+            o.cy = int(y + o.SIZE/2)
+        for (o, s) in statics:
+            if isinstance(o, Ammo):
+                o.pickedup = False
+        if spots:
+            # Crumbs moved, it is quicker to fill a new broadphase than to move them
+            stat = self.broadphase_stat = StaticGrid(self.field.width, self.field.height, 
+                                                     self.field.tilesize)
+            for (o, s) in sorted(statics, key=lambda e: (e[0]._x, e[1])):
+                stat.add(o, seq=s)
+        else:
+            # Remove the pickups that were spawned, put back those that were picked up
+            stat = self.broadphase_stat
+            for o in [o for o in stat if isinstance(o, Ammo) and o.uid >= object_uid]:
+                stat.remove(o)
+            for (o, s) in statics:
+                if id(o) not in stat.seqs:
+                    stat.add(o, seq=s)
+        stat.seq = seq
+        for o in allobjects:
+            if isinstance(o, ControlPoint):
+                o.team = TEAM_NEUTRAL
+                o.graphic = 'cp_neutral'
+                o.collided = [0, 0, 0]
+                o.touching = []
+        for (fountain, kids) in children:
+            fountain.countdown = -1
+            fountain.children = list(kids)
+        self.objects = list(objects)
+        self.object_uid = object_uid
+        self.static_version += 1
+        return True
+
     def run(self):
         """ Start and loop the game. """
         if self.state != Game.STATE_READY:
             self._setup()
-        res      = Game.SIMULATION_SUBSTEPS
-        render   = self.renderer is not None
-        settings = self.settings
         ## MAIN GAME LOOP
         self.state = Game.STATE_RUNNING
         try:
-            for s in range(settings.max_steps):
-                self.step = s+1
-                if self.step % 10 == 0:
-                    print("Step %d: %d - %d"%(self.step, self.score_red, self.score_blue))
-                if self.step_callback is not None:
-                    self.step_callback(self)
-                ## UPDATE & CHECK VICTORY
-                p = time.clock()
-                for o in self.objects:
-                    o.update()
-                for t in self.tanks:
-                    t.send_observation()
-                for t in self.tanks:
-                    t.get_action()
-                # Compute shooting
-                for tank in self.tanks:
-                    tank.hit = None
-                    tank.clicked = []
-                    if tank.shoots:
-                        tcx, tcy = tank._x + tank.width/2, tank._y + tank.height/2
-                        target = (cos(tank.angle) * settings.max_range + tcx, 
-                                  sin(tank.angle) * settings.max_range + tcy)
-                        hits   = self._raycast((tcx, tcy), target, exclude=tank)
-                        tank._hitx, tank._hity = target
-                        if hits:
-                            t, (px,py), who = hits[0]
-                            tank._hitx, tank._hity = px, py
-                            if isinstance(who, Tank):
-                                tank.hit = who.team
-                                who.respawn_in = self.settings.spawn_time
-                
-                # Record times
-                self.update_time_total += time.clock() - p
-                sum_red = sum(tank.time_thought for tank in self.tanks_red)
-                sum_blue = sum(tank.time_thought for tank in self.tanks_blue)
-                self.stats.think_time_red += sum_red
-                self.stats.think_time_blue += sum_blue
-                if self.tanks_red:
-                    self.think_time_red = sum_red / len(self.tanks_red)
-                if self.tanks_blue:
-                    self.think_time_blue = sum_blue / len(self.tanks_blue)
-                # Score ending condition
-                if ((self.settings.end_condition & ENDGAME_SCORE) and 
-                    (self.score_red == 0 or self.score_blue == 0)):
-                    break
-                # No crumbs left ending condition
-                if ((self.settings.end_condition & ENDGAME_CRUMBS) and
-                    not any(True for o in allobjects if isinstance(o, Crumb))):
+            for s in range(self.settings.max_steps):
+                self._begin_step()
+                self._act()
+                if self._end_step():
                     break
-                ## RESET SOME STUFF
-                if render:
-                    self.keys = []
-                ## SIMULATE AND RENDER
-                for o in self.objects:
-                    if o.movable:
-                        o._dx = (o.x - o._x) / res
-                        o._dy = (o.y - o._y) / res
-                        if render:
-                            o._da = (o.angle - o._a) / renderer.ROTATION_FRAMES
-                # Render rotation/shooting
-                if render:
-                    for _ in range(renderer.ROTATION_FRAMES):
-                        for o in self.objects:
-                            o._a += o._da
-                        self.renderer.render(self)
-                    for f in range(renderer.SHOOTING_FRAMES):
-                        self.renderer.render(self, shooting_frame = f)
-                
-                # Reset tanks that got shot
-                for tank in self.tanks:
-                    if tank.respawn_in == self.settings.spawn_time:
-                        if tank.team == TEAM_RED:
-                            self.stats.deaths_red += 1
-                        else:
-                            self.stats.deaths_blue += 1
-                        tank.ammo = 0
-                        tank.x = tank._x = tank.spawn.x + 2
-                        tank.y = tank._y = tank.spawn.y + 2
-                        tank._dx = tank._dy = 0
-                        tank.angle = tank._a = tank.spawn.angle                        
-                
-                # Simulate/Render movement
-                self.sim_time = 0.0
-                for step in range(res):
-                    p = time.clock()
-                    # Perform one physics substep
-                    self._substep()
-                    self.sim_time += time.clock() - p
-                    if render:
-                        self.renderer.render(self)
-                self.sim_time_total += self.sim_time
-                for o in self.objects:
-                    if o.movable:
-                        o.x = o._x
-                        o.y = o._y
-                        o._a = o.angle = angle_fix(o.angle)
         except GameInterrupt:
             self.state = Game.STATE_INTERRUPT
         except KeyboardInterrupt:
             self.state = Game.STATE_INTERRUPT
         self._end(interrupted=(self.state==Game.STATE_INTERRUPT))
         return self # For chaining, if you're into that.
+
+    def reset(self):
+        """ Starts a new game that is controlled with :meth:`advance`
+            instead of by the agents, the agents are not loaded.
+            The field is reused, and so are its objects, see :meth:`run`.
+
+            :returns: The observations of all tanks, red first, then blue.
+        """
+        if self.state == Game.STATE_RUNNING:
+            self.old_stdout, sys.stdout = sys.stdout, self.log
+            self._end(interrupted=True)
+        self._setup(brains=False)
+        try:
+            self.state = Game.STATE_RUNNING
+            self._begin_step()
+        finally:
+            sys.stdout = self.old_stdout
+        return [tank.observation for tank in self.tanks]
+
+    def advance(self, actions):
+        """ Does one step of a game that was started with :meth:`reset`.
+            When the game is over, it is ended, and the observations
+            are those of the last step.
+
+            :param actions: A (turn, speed, shoot) tuple for each tank,
+                            in the same order as the observations.
+            :returns: A tuple of the observations, a tuple with the points that
+                      red and blue scored in this step, and whether the game is over.
+        """
+        if self.state != Game.STATE_RUNNING:
+            raise Exception("Call reset() to start a game before calling advance().")
+        if len(actions) != len(self.tanks):
+            raise Exception("Expected %d actions, got %d."%(len(self.tanks), len(actions)))
+        (score_red, score_blue) = (self.score_red, self.score_blue)
+        stdout, sys.stdout = sys.stdout, self.log
+        try:
+            for (tank, (turn, speed, shoot)) in zip(self.tanks, actions):
+                tank.team_action = (turn, speed, shoot)
+            self._act()
+            done = self._end_step()
+            if done:
+                self._end()
+            else:
+                self._begin_step()
+        finally:
+            sys.stdout = stdout
+        rewards = (self.score_red - score_red, self.score_blue - score_blue)
+        return [tank.observation for tank in self.tanks], rewards, done
+
+    def snapshot(self):
+        """ Returns a :class:`~domination.core.GameSnapshot` of the state of
+            the game, to go back to later with :meth:`restore`. Take it between
+            two steps, e.g. after :meth:`reset` or :meth:`advance`.
+        """
+        return GameSnapshot(self)
+
+    def restore(self, snapshot):
+        """ Puts the game back in the state of the snapshot, the game statistics
+            are not restored. If the game isn't running, it is started with
+            :meth:`reset` first, so this also sets up a game without agents
+            to simulate ahead with :meth:`advance`::
+
+                sim = Game(field=game.field, settings=game.settings, rendered=False)
+                sim.restore(game.snapshot())
+
+            :returns: The observations of all tanks, like :meth:`reset`.
+        """
+        if snapshot.field is not self.field and snapshot.field != self.field:
+            raise Exception("Cannot restore a snapshot of a game on another field.")
+        if self.state != Game.STATE_RUNNING:
+            self.reset()
+        stdout, sys.stdout = sys.stdout, self.log
+        try:
+            self.step = snapshot.step
+            (self.score_red, self.score_blue) = snapshot.score
+            self.random.setstate(snapshot.random)
+            for (tank, state) in zip(self.tanks, snapshot.tanks):
+                (tank.x, tank.y, tank.angle, tank.ammo, tank.respawn_in, tank.hit, collided) = state
+                tank._x, tank._y, tank._a = tank.x, tank.y, tank.angle
+                tank._dx = tank._dy = 0
+                # Forget the contacts, and look at the walls again
+                tank._still = False
+                tank._contacts = ()
+                tank.grid_x = tank.grid_y = None
+                tank.observation.collided = collided
+            self.contacts = {}
+            self.broadphase_mov.update()
+            self.broadphase_mov.objects[:] = [self.tanks[i] for i in snapshot.order]
+            for (cp, team) in zip(self.controlpoints, snapshot.controlpoints):
+                cp.team = team
+                cp.graphic = 'cp_red' if team == TEAM_RED else 'cp_blue' if team == TEAM_BLUE else 'cp_neutral'
+            for (fountain, countdown) in zip(self.fountains, snapshot.fountains):
+                fountain.countdown = countdown
+            # Only recreate the pickups if any of them changed
+            if self._pickups() != snapshot.pickups:
+                for o in [o for o in self.broadphase_stat if isinstance(o, Ammo)]:
+                    self._rem_object(o)
+                for (cls, parent, x, y) in snapshot.pickups:
+                    o = cls(x, y)
+                    if parent is not None:
+                        o.parent = self.fountains[parent]
+                        o.parent.children.append(o)
+                    self._add_object(o)
+            self._observe()
+        finally:
+            sys.stdout = stdout
+        return [tank.observation for tank in self.tanks]
+
+    def _pickups(self, fountains=None):
+        """ Returns (class, fountain, x, y) for each ammo pack and crumb,
+            in the order of the broadphase.
+        """
+        if fountains is None:
+            fountains = dict((f, i) for (i, f) in enumerate(self.fountains))
+        return tuple((o.__class__, fountains[o.parent] if hasattr(o, 'parent') else None, o.x, o.y)
+                     for o in self.broadphase_stat if isinstance(o, Ammo))
+
+    def _begin_step(self):
+        """ Starts the next step, updates all objects and sends
+            the tanks their observations.
+        """
+        clock = time.perf_counter_ns
+        self.step += 1
+        if self.step % 10 == 0:
+            print("Step %d: %d - %d"%(self.step, self.score_red, self.score_blue))
+        if self.step_callback is not None:
+            self.step_callback(self)
+        ## UPDATE & CHECK VICTORY
+        t_update = clock()
+        for o in self.objects:
+            o.update()
+        t_end = clock()
+        self.phase_ns['update'] += t_end - t_update
+        self.update_time_total += (t_end - t_update) * 1e-9
+        self._observe()
+        
+    def _observe(self):
+        """ Sends the tanks their observations. """
+        t_observe = time.perf_counter_ns()
+        self._index_visible()
+        for t in self.tanks:
+            t.send_observation()
+        t_end = time.perf_counter_ns()
+        self.phase_ns['observe'] += t_end - t_observe
+        self.update_time_total += (t_end - t_observe) * 1e-9
+        
+    def _act(self):
+        """ Gets the actions of all tanks from their brains, tanks
+            without a brain do their team_action.
+        """
+        clock = time.perf_counter_ns
+        t_act = clock()
+        if self.workers:
+            self._workers_think()
+        for (brain, tanks) in self.team_brains:
+            self._team_think(brain, tanks)
+        for t in self.tanks:
+            t.get_action()
+        t_end = clock()
+        self.phase_ns['act'] += t_end - t_act
+        self.update_time_total += (t_end - t_act) * 1e-9
+        
+    def _end_step(self):
+        """ Resolves the shots and simulates the movement of the tanks.
+            Returns True if the game is over.
+        """
+        res      = Game.SIMULATION_SUBSTEPS
+        render   = self.renderer is not None
+        substep  = self._substep if self.physics is None else self.physics.substep
+        settings = self.settings
+        clock    = time.perf_counter_ns
+        phase_ns = self.phase_ns
+        # Compute shooting
+        t_shoot = clock()
+        self._resolve_shots()
+        
+        # Record times
+        t_end = clock()
+        phase_ns['shoot'] += t_end - t_shoot
+        self.update_time_total += (t_end - t_shoot) * 1e-9
+        sum_red = sum(tank.time_thought for tank in self.tanks_red)
+        sum_blue = sum(tank.time_thought for tank in self.tanks_blue)
+        self.stats.think_time_red += sum_red
+        self.stats.think_time_blue += sum_blue
+        if self.tanks_red:
+            self.think_time_red = sum_red / len(self.tanks_red)
+        if self.tanks_blue:
+            self.think_time_blue = sum_blue / len(self.tanks_blue)
+        # Score ending condition
+        if ((settings.end_condition & ENDGAME_SCORE) and 
+            (self.score_red == 0 or self.score_blue == 0)):
+            return True
+        # No crumbs left ending condition
+        if ((settings.end_condition & ENDGAME_CRUMBS) and
+            not any(True for o in self.objects if isinstance(o, Crumb))):
+            return True
+        # Agents can still read their last observation in finalize()
+        if settings.lazy_observations and self.step == settings.max_steps:
+            for t in self.tanks:
+                t.observation.resolve()
+        ## RESET SOME STUFF
+        if render:
+            self.keys = []
+        ## SIMULATE AND RENDER
+        for o in self.objects:
+            if o.movable:
+                o._dx = (o.x - o._x) / res
+                o._dy = (o.y - o._y) / res
+                if render:
+                    o._da = (o.angle - o._a) / renderer.ROTATION_FRAMES
+        # Render rotation/shooting
+        if render:
+            p = clock()
+            for _ in range(renderer.ROTATION_FRAMES):
+                for o in self.objects:
+                    o._a += o._da
+                self.renderer.render(self)
+            for f in range(renderer.SHOOTING_FRAMES):
+                self.renderer.render(self, shooting_frame = f)
+            phase_ns['render'] += clock() - p
+        
+        # Reset tanks that got shot
+        for tank in self.tanks:
+            if tank.respawn_in == settings.spawn_time:
+                if tank.team == TEAM_RED:
+                    self.stats.deaths_red += 1
+                else:
+                    self.stats.deaths_blue += 1
+                tank.ammo = 0
+                tank.x = tank._x = tank.spawn.x + 2
+                tank.y = tank._y = tank.spawn.y + 2
+                tank._dx = tank._dy = 0
+                tank._still = False
+                tank.angle = tank._a = tank.spawn.angle                        
+        
+        # Simulate/Render movement
+        sim_ns = 0
+        for step in range(res):
+            p = clock()
+            # Perform one physics substep
+            substep()
+            sim_ns += clock() - p
+            if render:
+                p = clock()
+                self.renderer.render(self)
+                phase_ns['render'] += clock() - p
+        phase_ns['substep'] += sim_ns
+        self.sim_time = sim_ns * 1e-9
+        self.sim_time_total += self.sim_time
+        for o in self.objects:
+            if o.movable:
+                o.x = o._x
+                o.y = o._y
+                o._a = o.angle = angle_fix(o.angle)
+        return self.step >= settings.max_steps
     
     def _end(self, interrupted=False):
         """ End the game  and tells all the agents that the game
@@ -572,6 +1249,7 @@ class Game(object):
         self.stats.score_blue = self.score_blue
         self.stats.score = self.score_red / float(self.score_red + self.score_blue)
         self.stats.steps = self.step
+        self.stats.phase_time = dict((phase, ns * 1e-9) for (phase, ns) in self.phase_ns.items())
         print(self.stats)
         if self.record:
             self.replay.settings = copy.copy(self.settings)
@@ -581,7 +1259,12 @@ class Game(object):
         # Finalize tanks brains.
         if self.record or self.replay is None:
             for tank in self.tanks:
-                self._agent_call(tank.brain.finalize, args=[interrupted], team=tank.team)
+                if tank.brain is not None:
+                    self._agent_call(tank.brain.finalize, args=[interrupted], team=tank.team)
+            for (brain, tanks) in self.team_brains:
+                self._agent_call(brain.finalize, args=[interrupted], team=tanks[0].team)
+            for worker in self.workers:
+                worker.finalize(interrupted)
                     
         # Set the stdout back to whatever it was before
         sys.stdout = self.old_stdout
@@ -592,59 +1275,84 @@ class Game(object):
             and all objects are repeatedly separated until no large collisions
             occur anymore. 
         """
-        for o in self.broadphase_mov:
+        mov  = self.broadphase_mov
+        stat = self.broadphase_stat
+        objs = mov.objects
+        can_sleep = Game.SIMULATION_SLEEP
+        sleeping = False
+        for o in objs:
             o._x += o._dx
             o._y += o._dy
-            o._moved = True # if (o._dx != 0 or o._dy != 0) else False
-        something_collided = True
+            # Objects that stand still and weren't pushed during the
+            # last substep are asleep, they have the same contacts.
+            still = can_sleep and o._dx == 0 and o._dy == 0
+            o._sleeping = o._still and still
+            o._moved = not o._sleeping
+            o._still = still
+            sleeping = sleeping or o._sleeping
+        # Contacts are remembered from the first iteration only, and only
+        # for objects that stand still, the others can't fall asleep next.
+        first = True
         iteration = Game.SIMULATION_MAXITER
-        pairs = set([])
-        while something_collided and iteration > 0:
-            self.broadphase_mov.sort(key=lambda o:(o._x))
-            collisions = []
-            k = 0
-            for i, o1 in enumerate(self.broadphase_mov):
-                for o2 in self.broadphase_mov[i+1:]:
-                    # If the object didn't move, no need to check.
-                    if o2._moved or o1._moved: 
-                        # Break if the next object's _x is already outside
-                        # this object's bounds. (The essential bit)
-                        if o2._x >= o1._x + o1.width:
-                            break
-                        # Otherwise check if the y's intersect too
-                        if o2._y < (o1._y + o1.height) and o1._y < (o2._y + o2.height):
-                            sep = self._compute_separation(o1,o2)
-                            if sep is not None:
-                                if o1.solid and o2.solid:
-                                    collisions.append(sep)
-                                if (o1, o2) not in pairs:
-                                    pairs.add((o2, o1))
+        pairs = {}
+        while iteration > 0:
+            mov.update()
+            n = len(objs)
+            found = []
+            contacts = {}
+            for (i, j) in mov.overlaps():
+                o1, o2 = objs[i], objs[j]
+                # If the objects didn't move, no need to check.
+                if o1._moved or o2._moved:
+                    # The x's intersect, check if the y's intersect too
+                    if o2._y < (o1._y + o1.height) and o1._y < (o2._y + o2.height):
+                        sep = self._compute_separation(o1,o2)
+                        if sep is not None:
+                            found.append((i, j, sep))
+                            if first and o1._still and o2._still:
+                                contacts[id(o1), id(o2)] = sep
+                # Two sleeping objects still touch if they did before.
+                elif sleeping and first and o1._sleeping and o2._sleeping:
+                    sep = self.contacts.get((id(o1), id(o2)))
+                    if sep is not None:
+                        found.append((i, j, sep))
+                        contacts[id(o1), id(o2)] = sep
+            if first:
+                self.contacts = contacts
+            for i, o1 in enumerate(objs):
                 if o1._moved:
-                    sf = True
-                    for o2 in self.broadphase_stat[k:]:
-                        # Maintain marker index for static broadphase
-                        if o2._x + o2.width <= o1._x:
-                            if sf:
-                                k += 1
-                            continue
-                        elif sf:
-                            sf = False
-                        # Break if the next object's _x is already outside
-                        # this object's bounds. (The essential bit)
-                        if o2._x >= o1._x + o1.width:
-                            break
-                        # Otherwise check if the y's intersect too
-                        if o2._y < (o1._y + o1.height) and o1._y < (o2._y + o2.height):
+                    l, t = o1._x, o1._y
+                    r, b = l + o1.width, t + o1.height
+                    k = len(found)
+                    for (x2, _, o2) in stat.query(l, r, t, b):
+                        # Check if both the x's and the y's intersect
+                        if (x2 < r and l < (x2 + o2.width) and
+                            o2._y < b and t < (o2._y + o2.height)):
                             sep = self._compute_separation(o1,o2)
                             if sep is not None:
-                                if o1.solid and o2.solid:
-                                    collisions.append(sep)
-                                if (o1, o2) not in pairs:
-                                    pairs.add((o2, o1))
+                                found.append((i, n + len(found), sep))
+                    if first and o1._still:
+                        o1._contacts = [f[2] for f in found[k:]]
                     o1._moved = False
-            something_collided = len(collisions) > 0
+                elif sleeping and first and o1._sleeping:
+                    for sep in o1._contacts:
+                        found.append((i, n + len(found), sep))
+            if not found:
+                break
+            # Handle the pairs in sweep order, so that equally deep
+            # collisions are always resolved in the same order.
+            found.sort()
+            collisions = []
+            for (_, _, sep) in found:
+                o1, o2 = sep[1], sep[2]
+                if o1.solid and o2.solid:
+                    collisions.append(sep)
+                key = (id(o1), id(o2)) if id(o1) < id(o2) else (id(o2), id(o1))
+                if key not in pairs:
+                    pairs[key] = (o2, o1)
             # Sort the collisions on their first property, the penetration distance.
             collisions.sort(reverse=True, key=lambda c: c[0])
+            moved = False
             for (p, o1, o2, px, py) in collisions:
                 if p < 1: 
                     break
@@ -659,33 +1367,65 @@ class Game(object):
                             o2._y -= dy
                             o1._moved = True
                             o2._moved = True
+                            o1._still = o2._still = False
                         else:
                             o1._x += px
                             o1._y += py
                             o1._moved = True
+                            o1._still = False
                     else:
                         o2._x -= px
                         o2._y -= py
                         o2._moved = True
+                        o2._still = False
+                    moved = True
+            # If nothing was separated, there is nothing new to find.
+            if not moved:
+                break
+            first = False
             iteration -= 1
-        pairs = sorted(pairs)
-        for (o1,o2) in pairs:
-            o1.collide(o2)
-            o2.collide(o1)
+        self._collide(sorted(pairs.values()))
+        
+    def _collide(self, pairs):
+        """ Calls collide() on both objects of each colliding pair, 
+            but only on objects that react to the other object's type
+            (see GameObject.COLLIDES_WITH). Control points then count 
+            the tanks that touched them all at once.
+        """
+        handlers = self.collision_handlers
+        for (o1, o2) in pairs:
+            key = (o1.__class__, o2.__class__)
+            try:
+                (h1, h2) = handlers[key]
+            except KeyError:
+                (t1, t2) = key
+                h1 = t1.collide if issubclass(t2, t1.COLLIDES_WITH) else None
+                h2 = t2.collide if issubclass(t1, t2.COLLIDES_WITH) else None
+                handlers[key] = (h1, h2)
+            if h1 is not None:
+                h1(o1, o2)
+            if h2 is not None:
+                h2(o2, o1)
+        for cp in self.controlpoints:
+            if cp.touching:
+                cp.tally()
         
     def _add_object(self,o):
         """ Add an object to the game and collision list. """
         o.game = self
-        o.uid = hashlib.md5(str(self.object_uid).encode()).digest()
+        o.uid = self.object_uid
+        # Sorts like the MD5 digests that were the uids before, so that the
+        # collision callbacks are made in the same order as in older versions.
+        o.sortkey = int.from_bytes(hashlib.md5(str(self.object_uid).encode()).digest(), 'big')
         self.object_uid += 1
         self.objects.append(o)
         if o.physical:
             if o.movable:
-                self.broadphase_mov.append(o)
-                self.broadphase_mov.sort(key=lambda o:(o._x))
+                self.broadphase_mov.add(o)
             else:
-                self.broadphase_stat.append(o)
-                self.broadphase_stat.sort(key=lambda o:(o._x))
+                self.broadphase_stat.add(o)
+                self._wake_objects(o)
+                self.static_version += 1
         o.added_to_game(self)
         
     def _rem_object(self,o):
@@ -696,10 +1436,32 @@ class Game(object):
                 self.broadphase_mov.remove(o)
             else:
                 self.broadphase_stat.remove(o)
+                self._wake_objects(o)
+                self.static_version += 1
         # Check if we need to remove this object from a parent
         if hasattr(o, 'parent'):
             o.parent.remove_child(o)
                 
+    def _wake_objects(self, o):
+        """ Wakes up the sleeping objects that touch the given object. """
+        for m in self.broadphase_mov:
+            if (m._x <= o._x + o.width and o._x <= m._x + m.width and
+                m._y <= o._y + o.height and o._y <= m._y + m.height):
+                m._still = False
+                
+    def _index_visible(self):
+        """ Puts the tanks and the ammo on the vision grid, in the order that
+            _get_objects_in_bounds would find them, and collects the state
+            of the control points that all tanks observe.
+        """
+        items = [(o, None) for o in self.broadphase_mov if isinstance(o, Tank)]
+        items.extend((o, (o.cx, o.cy, "Ammo")) for o in self.broadphase_stat 
+                     if isinstance(o, Ammo))
+        self.vision.build(items)
+        self.visible_cps = tuple((cp.cx,cp.cy,cp.team) for cp in self.controlpoints)
+        for arrays in self.observation_arrays:
+            arrays.set_cps(self.visible_cps)
+    
     def _get_objects_in_bounds(self, xmin, xmax, ymin, ymax, solid_only=True):
         """ Return a list of all objects whose bounding boxes
             intersect the given bounds.
@@ -710,10 +1472,8 @@ class Game(object):
             if (not solid_only or o.solid) and o._x + o.width > xmin:
                 if ymin < (o._y + o.height) and o._y < ymax:
                     yield o
-        for o in self.broadphase_stat:
-            if o._x > xmax:
-                break
-            if (not solid_only or o.solid) and o._x + o.width > xmin:
+        for (_, _, o) in self.broadphase_stat.query(xmin, xmax, ymin, ymax):
+            if (not solid_only or o.solid) and o._x <= xmax and o._x + o.width > xmin:
                 if ymin < (o._y + o.height) and o._y < ymax:
                     yield o
     
@@ -828,20 +1588,99 @@ class Game(object):
         hits = []
         for o in in_box:
             if o != exclude:
-                if o.shape == GameObject.SHAPE_RECT:
-                    isect = line_intersects_rect(p0,p1,(o._x,o._y,o.width,o.height))
-                    if isect:
-                        # Append the t0 (intersection time) and object
-                        hits.append((isect[0][0],isect[0][1],o))
-                elif o.shape == GameObject.SHAPE_CIRC:
-                    r = o.width/2
-                    isect = line_intersects_circ(p0,p1,(o._x+r,o._y+r),r)
-                    if isect:
-                        # Append the t0 (intersection time), position and object
-                        hits.append((isect[0][0],isect[0][1],o))
+                isect = self._intersect(p0, p1, o)
+                if isect:
+                    # Append the t0 (intersection time), position and object
+                    hits.append((isect[0][0],isect[0][1],o))
         hits.sort(key=lambda h: h[0])
         return hits
     
+    def _intersect(self, p0, p1, o):
+        """ Intersects the line from p0 to p1 with the shape of the 
+            given object, returns a list of (t, (x, y)) or False.
+        """
+        if o.shape == GameObject.SHAPE_RECT:
+            return line_intersects_rect(p0,p1,(o._x,o._y,o.width,o.height))
+        elif o.shape == GameObject.SHAPE_CIRC:
+            r = o.width/2
+            return line_intersects_circ(p0,p1,(o._x+r,o._y+r),r)
+        return False
+    
+    def _resolve_shots(self):
+        """ Computes what the shots of all shooting tanks hit. This gives
+            the same results as a _raycast for each shot, but looks up the
+            walls within range of the shooter's tile in a table, and shares 
+            the work of finding nearby tanks between shots.
+        """
+        shooters = []
+        for tank in self.tanks:
+            tank.hit = None
+            tank.clicked = []
+            if tank.shoots:
+                shooters.append(tank)
+        if not shooters:
+            return
+        settings = self.settings
+        ts = self.field.tilesize
+        # For each tile, the wall rects that a shot fired from it can reach
+        if self.walls_in_range is None:
+            grid = self.field.wallgrid
+            h, w = len(grid), len(grid[0])
+            n = int(settings.max_range // ts) + 1
+            tiles = [[[] for j in range(w)] for i in range(h)]
+            for r in self.field.wallrects:
+                (x, y, rw, rh) = r
+                for i in range(max(int(y // ts) - n, 0), min(int((y + rh) // ts) + n, h)):
+                    for j in range(max(int(x // ts) - n, 0), min(int((x + rw) // ts) + n, w)):
+                        tiles[i][j].append(r)
+            self.walls_in_range = [[tuple(rects) for rects in row] for row in tiles]
+        walls = self.walls_in_range
+        h, w = len(walls), len(walls[0])
+        # _raycast finds tanks by going through the broadphase list until
+        # it passes an object beyond the ray, the running maximum of _x
+        # tells us where that happens, and where the ray's box starts.
+        objs = self.broadphase_mov.objects
+        reach = []
+        running = -inf
+        maxwidth = 0
+        for o in objs:
+            running = o._x if o._x > running else running
+            reach.append(running)
+            maxwidth = o.width if o.width > maxwidth else maxwidth
+        for tank in shooters:
+            p0x, p0y = p0 = (tank._x + tank.width/2, tank._y + tank.height/2)
+            p1x, p1y = p1 = (cos(tank.angle) * settings.max_range + p0x, 
+                             sin(tank.angle) * settings.max_range + p0y)
+            xmin, xmax = (p0x, p1x) if p0x < p1x else (p1x, p0x)
+            ymin, ymax = (p0y, p1y) if p0y < p1y else (p1y, p0y)
+            # The first hit as (t, point, object). Tanks are tested before
+            # walls and only a strictly earlier hit replaces the best one,
+            # which breaks ties in the order that _raycast finds them.
+            best = None
+            for k in range(bisect.bisect_left(reach, xmin - maxwidth), 
+                           bisect.bisect_right(reach, xmax)):
+                o = objs[k]
+                if (o.solid and o is not tank and o._x + o.width > xmin and
+                    ymin < (o._y + o.height) and o._y < ymax):
+                    isect = self._intersect(p0, p1, o)
+                    if isect and (best is None or isect[0][0] < best[0]):
+                        best = (isect[0][0], isect[0][1], o)
+            i = min(max(int(p0y // ts), 0), h - 1)
+            j = min(max(int(p0x // ts), 0), w - 1)
+            for r in walls[i][j]:
+                if (r[0] <= xmax and r[0] + r[2] > xmin and
+                    ymin < (r[1] + r[3]) and r[1] < ymax):
+                    isect = line_intersects_rect(p0, p1, r)
+                    if isect and (best is None or isect[0][0] < best[0]):
+                        best = (isect[0][0], isect[0][1], None)
+            tank._hitx, tank._hity = p1
+            if best is not None:
+                tank._hitx, tank._hity = best[1]
+                who = best[2]
+                if isinstance(who, Tank):
+                    tank.hit = who.team
+                    who.respawn_in = settings.spawn_time
+    
     def _click(self, xxx_todo_changeme, shift):
         """ Tells the game that the right-mouse button was clicked
             somewhere on the field.
@@ -906,6 +1745,13 @@ class Field(object):
     CLEAR     = '_'
     REACHABLE = '.'
     
+    #: Directory where unpacked fields are cached, so that a field with the 
+    #: same tiles is only unpacked once, also in other processes. Off if None.
+    #: The files only hold plain data, but whoever can write to the directory
+    #: decides the walls and objects of the fields that are read from it, so
+    #: use a directory that only you can write to.
+    CACHE_DIR = None
+    
     def __init__(self, width, height, tilesize):
         # Settings variables
         self.width            = width
@@ -924,9 +1770,10 @@ class Field(object):
     
     ## BUILTINS
     def __getstate__(self):
-        """ Used for pickling, removes the _unpacked property """
-        self._unpacked = None
-        return self.__dict__
+        """ Used for pickling, leaves out the _unpacked property """
+        state = self.__dict__.copy()
+        state['_unpacked'] = None
+        return state
     
     def __str__(self):
         """ Returns the ASCII representation of this field """
@@ -996,25 +1843,27 @@ class Field(object):
                 if mirror:
                     self.tiles[y][self.width-1-x] = marker
             
-    def scatter(self, marker, num, pad=1, mirror=True):
-        """ Scatter markers over the map, symmetrically or not."""
+    def scatter(self, marker, num, pad=1, mirror=True, rng=random):
+        """ Scatter markers over the map, symmetrically or not,
+            using the given random number generator.
+        """
         midline = int(self.width / 2.0 + 0.5)
         if mirror:
             bounds = (pad, pad, midline-pad, self.height - pad)
             clear = self.find(Field.CLEAR, bounds=bounds)
             # Begin by scattering half of the points.
-            points = random.sample(clear, num // 2)
+            points = rng.sample(clear, num // 2)
             self.set(points, marker, mirror=True)
             # If odd number, add one more on midline:
             if num%2:
                 bounds = (midline-1, pad, midline, self.height - pad)
-                point = random.choice(self.find(Field.CLEAR, bounds=bounds))
+                point = rng.choice(self.find(Field.CLEAR, bounds=bounds))
                 self.set(point, marker)
         else:
             # If not mirroring, just scatter the whole bunch.
             bounds = (pad, pad, self.width-1-pad, self.height-1-pad)
             clear = self.find(Field.CLEAR, bounds=bounds)
-            points = random.sample(clear, num)
+            points = rng.sample(clear, num)
             self.set(points, marker)
                     
     def fill_unreachable(self):
@@ -1052,7 +1901,13 @@ class Field(object):
             actually created yet, but GENERATED ON THE FLY
             when the game asks for them, so that each
             game gets a shiny new batch of game objects.
+            The navigation mesh is only made when it is
+            first asked for, games without agents don't
+            need it. When :attr:`CACHE_DIR` is set, the 
+            result is read from the cache if it is there.
         """
+        if self._read_cache():
+            return
         _unpacked = {'wallrects':[],
                      'objects': [],
                      'mesh': None,
@@ -1093,19 +1948,82 @@ class Field(object):
         _unpacked['objects'].extend( (Wall, {'x':x, 'y':y, 'width':w, 'height':h}) 
                                         for (x,y,w,h) in _unpacked['wallrects'] )
         
-        # Generate nav mesh
-        add_points = [(o.cx, o.cy) for o in _unpacked['objects'] if 
-                        (isinstance(o,Ammo) or isinstance(o,ControlPoint))]
-        _unpacked['mesh'] = make_nav_mesh(_unpacked['wallrects'], simplify=0.3,add_points=add_points)
-        
         # Generate wall grid
         _unpacked['grid'] = [[(1 if t == self.WALL else 0) for t in row] for row in self.tiles]
 
         self._unpacked = _unpacked
+    
+    def cache_key(self):
+        """ Returns a hash of the tiles and the tilesize, which
+            are all that the unpacked field depends on.
+        """
+        return hashlib.sha1(repr((__version__, self.tilesize, self.tiles)).encode('utf-8')).hexdigest()
+    
+    def _cache_path(self):
+        return os.path.join(Field.CACHE_DIR, 'field_%s.json' % self.cache_key())
+    
+    def _read_cache(self):
+        """ Loads the unpacked field and its mesh from the cache,
+            returns False if caching is off, it isn't cached yet, or
+            the file doesn't hold what _write_cache writes. Objects 
+            are looked up by name in CACHED_CLASSES.
+        """
+        if Field.CACHE_DIR is None:
+            return False
+        number = (int, float)
+        try:
+            with open(self._cache_path(), 'r') as f:
+                (wallrects, objects, grid, nodes, edges) = json.load(f)
+            wallrects = [tuple(r) for r in wallrects]
+            nodes = [tuple(n) for n in nodes]
+            objects = [(Field.CACHED_CLASSES[name], kwargs) for (name, kwargs) in objects]
+            if not (all(len(r) == 4 and all(isinstance(v, number) for v in r) for r in wallrects) and
+                    all(len(n) == 2 and all(isinstance(v, number) for v in n) for n in nodes) and
+                    all(t in (0, 1) for row in grid for t in row) and
+                    all(set(kwargs) <= Field.CACHED_ARGS and 
+                        all(isinstance(v, number) for v in kwargs.values()) for (_, kwargs) in objects)):
+                return False
+            # The mesh is stored as lists of neighbour indices, in the original order
+            mesh = dict((n, {}) for n in nodes)
+            for (n1, neighbours) in zip(nodes, edges):
+                for i in neighbours:
+                    mesh[n1][nodes[i]] = point_dist(n1, nodes[i])
+        except Exception:
+            return False
+        self._unpacked = {'wallrects': wallrects, 'objects': objects, 'mesh': mesh, 'grid': grid}
+        return True
+    
+    def _write_cache(self):
+        """ Writes the unpacked field and its mesh to the cache, if caching is on. 
+            The file is moved in place when it is complete, so that
+            processes that read it at the same time never see half of it.
+        """
+        if Field.CACHE_DIR is None:
+            return
+        mesh = self._unpacked['mesh']
+        nodes = list(mesh)
+        index = dict((n, i) for (i, n) in enumerate(nodes))
+        edges = [[index[n2] for n2 in mesh[n1]] for n1 in nodes]
+        objects = [(cls.__name__, kwargs) for (cls, kwargs) in self._unpacked['objects']]
+        data = (self._unpacked['wallrects'], objects, self._unpacked['grid'], nodes, edges)
+        path = self._cache_path()
+        try:
+            os.makedirs(Field.CACHE_DIR, exist_ok=True)
+            temp = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp, path)
+        except (IOError, OSError) as e:
+            print("Could not cache field in %s: %s" % (Field.CACHE_DIR, e), file=sys.stderr)
         
     @property
     def mesh(self):
         if not self._unpacked: self.unpack()
+        if self._unpacked['mesh'] is None:
+            add_points = [(o.cx, o.cy) for o in self._unpacked['objects'] if 
+                            (isinstance(o,Ammo) or isinstance(o,ControlPoint))]
+            self._unpacked['mesh'] = make_nav_mesh(self._unpacked['wallrects'], simplify=0.3, add_points=add_points)
+            self._write_cache()
         return self._unpacked['mesh']
     
     @property
@@ -1118,6 +2036,29 @@ class Field(object):
         if not self._unpacked: self.unpack()
         return self._unpacked['wallrects']
     
+    def frozen(self):
+        """ Returns read-only versions of the wall rects, wall grid
+            and navigation mesh, that can be shared by all agents.
+        """
+        if not self._unpacked: self.unpack()
+        if 'frozen' not in self._unpacked:
+            self._unpacked['frozen'] = (freeze(self.wallrects), freeze(self.wallgrid), freeze(self.mesh))
+        return self._unpacked['frozen']
+        
+    def padded_wallgrid(self, pad):
+        """ Returns the wallgrid surrounded by a border of walls
+            that is pad tiles wide, so that windows around a tile
+            can be copied from it with slices. 
+        """
+        if not self._unpacked: self.unpack()
+        padded = self._unpacked.setdefault('padded', {})
+        if pad not in padded:
+            border = [[1] * (self.width + 2 * pad) for _ in range(pad)]
+            padded[pad] = (border + 
+                           [[1] * pad + row + [1] * pad for row in self.wallgrid] + 
+                           [row[:] for row in border])
+        return padded[pad]
+    
     def get_objects(self):
         """ Creates the gameobjects and returns them """
         if not self._unpacked: self.unpack()
@@ -1166,23 +2107,26 @@ class FieldGenerator(object):
         self.wall_gridsize    = wall_gridsize
     
 
-    def generate(self):
+    def generate(self, seed=None):
         """ Generates a new field using the parameters for random 
             distribution set in the constructor. 
             
+            :param seed: Seed for the random numbers, to generate the same field again. 
+                         Without it, the global random module is used.
             :returns: A :class:`~domination.core.Field` instance.
         """
+        rng = random if seed is None else random.Random(seed)
         # Create a new field
         field = Field(width=self.width, height=self.height, tilesize=self.tilesize)
 
         ## IMPORTANT OBJECTS
         # Add controlpoints
-        field.scatter(Field.CONTROL, self.num_points, pad = 4, mirror=self.mirror)        
+        field.scatter(Field.CONTROL, self.num_points, pad = 4, mirror=self.mirror, rng=rng)
         # Add sources of crumbs
-        field.scatter(Field.SOURCE, self.num_crumbsource, pad = 2, mirror=self.mirror)
+        field.scatter(Field.SOURCE, self.num_crumbsource, pad = 2, mirror=self.mirror, rng=rng)
         # Spawn regions
         spawn_h = int(sqrt(max(self.num_red, self.num_blue)) + 0.5) # height of the spawn block
-        spawn_y = random.randint(1, self.height - 2 - spawn_h)      # y-pos of the spawn block
+        spawn_y = rng.randint(1, self.height - 2 - spawn_h)         # y-pos of the spawn block
         for i in range(max(self.num_red, self.num_blue)):
             if i < self.num_red:
                 x = 1 + i // spawn_h
@@ -1205,20 +2149,20 @@ class FieldGenerator(object):
         while len(field.find('W')) < min_filled and attempts:
             new = field.clone()
             # Create horizontal section
-            if rand() < self.wall_orientation:
-                sec_width = random.randint(min_len,max_len)
+            if rng.random() < self.wall_orientation:
+                sec_width = rng.randint(min_len,max_len)
                 sec_height = self.wall_width
             # Create vertical section
             else:
                 sec_width = self.wall_width
-                sec_height = random.randint(min_len,max_len)
+                sec_height = rng.randint(min_len,max_len)
             # If map is mirrored, put stuff on left half only
             if self.mirror:
-                x = random.randint(1, midline - sec_width)
-                y = random.randint(1, self.height - sec_height - 1)
+                x = rng.randint(1, midline - sec_width)
+                y = rng.randint(1, self.height - sec_height - 1)
             else:
-                x = random.randint(1, self.width - sec_width)
-                y = random.randint(1, self.height - sec_height - 1)
+                x = rng.randint(1, self.width - sec_width)
+                y = rng.randint(1, self.height - sec_height - 1)
             
             # Round to gridsize
             x = (x // self.wall_gridsize) * self.wall_gridsize
@@ -1240,23 +2184,34 @@ class FieldGenerator(object):
                     field.set((_x,_y), Field.CLEAR, match=Field.WALL)
         
         ## ITEMS
-        field.scatter(Field.AMMO, self.num_ammo)
+        field.scatter(Field.AMMO, self.num_ammo, rng=rng)
         
         return field
 
 
 class GameObject(object):
-    """ Generic game object """
+    """ Generic game object. 
+    
+        Game objects use __slots__ instead of a __dict__, subclasses should 
+        list any attributes they add in their own __slots__. 
+    """
+    __slots__ = ('uid', 'sortkey', 'game', 'x', 'y', 'width', 'height', 'angle', 
+                 'shape', 'solid', 'movable', 'physical', 'graphic', 'cx', 'cy',
+                 '_x', '_y', '_a', '_dx', '_dy', '_da', '_moved', '_still',
+                 '_sleeping', '_contacts')
     
     SHAPE_RECT = 0
     SHAPE_CIRC = 1
     
     SIZE       = 12
     
+    COLLIDES_WITH = () # The types of objects that collide() is called for
+    
     def __init__(self, x=0.0, y=0.0, width=12, height=12, angle=0, shape=0, 
                        solid=True, movable=True, physical=True, graphic='default'):
         # Game variables
         self.uid      = -1
+        self.sortkey  = -1
         self.x        = float(x)
         self.y        = float(y)
         self.width    = float(width)
@@ -1278,6 +2233,9 @@ class GameObject(object):
         self._dy       = 0.0
         self._da       = 0.0
         self._moved    = False
+        self._still    = False
+        self._sleeping = False
+        self._contacts = ()
         
     def added_to_game(self, game):
         """ Tells the object that it has been added to the game,
@@ -1293,29 +2251,30 @@ class GameObject(object):
         
     def collide(self, other):
         """ Informs the object that it has collided with another.
-            Is called once per simulation substep.
+            Is called once per simulation substep, and only if
+            the other object is one of the COLLIDES_WITH types.
         """
         pass
         
-    def __eq__(self, other):
-        return id(self) == id(other)
-    
-    def __ne__(self, other):
-        return id(self) != id(other)
-    
+    # Objects are only equal to themselves, and are ordered 
+    # by their sortkey, which is fixed when they are added.
     def __lt__(self, other):
-        return self.uid < other.uid
+        return self.sortkey < other.sortkey
     
     def __cmp__(self, other):
         raise Exception("no sorting")
 
     def __hash__(self):
-        return hash(self.uid)
+        return self.uid
     
         
 ## Gameobject Subclasses
 
 class Tank(GameObject):
+    __slots__ = ('brain', 'id', 'team', 'ammo', 'selected', 'clicked', 'shoots',
+                 'hit', 'respawn_in', 'spawn', 'actions', 'record', 'time_thought',
+                 'observation', 'arrays', 'team_action', 'observe_ns', 'action_ns', 'latency',
+                 'grid_x', 'grid_y', '_hitx', '_hity')
     SIZE = 12
     SIZE_VACUBOT = 16
     
@@ -1342,15 +2301,27 @@ class Tank(GameObject):
         self.actions = actions if actions is not None else []
         self.record = record
         self.time_thought = 0.0
+        # The action that a TeamBrain picked for this tank.
+        self.team_action = (0,0,False)
+        # How long the brain took to observe and act in this step, in nanoseconds.
+        self.observe_ns = 0
+        self.action_ns = 0
+        self.latency = None
         # Additional hidden vars
         self._hitx = 0.0
         self._hity = 0.0
         self.grid_x = 0
         self.grid_y = 0
+        self.arrays = None
         
     def added_to_game(self, game):
+        self.latency = game.stats.latency.setdefault((self.team, self.id),
+            {'observe': LatencyHistogram(), 'action': LatencyHistogram(), 'think': LatencyHistogram()})
         # Initialize observation
-        self.observation = Observation()
+        if game.settings.lazy_observations:
+            self.observation = LazyObservation(self)
+        else:
+            self.observation = Observation()
         gridrng = (self.game.settings.max_see/2+1)//game.field.tilesize
         self.observation.walls = [[0 for _ in range(int(gridrng*2+1))] for _ in range(int(gridrng*2+1))]
         # Adjust settings for vacubot
@@ -1377,51 +2348,94 @@ class Tank(GameObject):
         obs.loc        = mx, my = (int(self.x+siz), int(self.y+siz))
         obs.angle      = self.angle
         obs.ammo       = self.ammo
-        obs.friends    = []
-        obs.foes       = []
-        obs.objects    = []
         obs.respawn_in = self.respawn_in
         obs.hit        = self.hit
         obs.score      = (self.game.score_red, self.game.score_blue)
         obs.selected   = self.selected
         obs.clicked    = self.clicked
         obs.keys       = self.game.keys
-        close = self.game._get_objects_in_bounds(self.x - rng, self.x + self.width + rng,
-                    self.y - rng, self.y + self.height + rng, solid_only=False)
-        
-        for o in close:
-            if isinstance(o, Tank):
-                if o.team == self.team:
-                    if o != self:
-                        obs.friends.append((int(o._x+siz), int(o._y+siz)))
+        self.game.stats.observations += 1
+        box = (self.x - rng, self.x + self.width + rng,
+               self.y - rng, self.y + self.height + rng)
+        f = self.game.field
+        tile = (mx//f.tilesize, my//f.tilesize)
+        if self.arrays is not None:
+            self.arrays.set_state(self)
+        else:
+            obs.cps = self.game.visible_cps
+        if self.game.settings.lazy_observations:
+            obs.defer(box, tile)
+        else:
+            self._observe_objects(box)
+            self._observe_walls(tile)
+        
+        if self.brain is not None:
+            last_clock = time.perf_counter_ns()
+            self.game._agent_call(self.brain.observe, args=[obs], team=self.team)
+            self.observe_ns = time.perf_counter_ns() - last_clock
+            self.time_thought = self.observe_ns * 1e-9
+        else:
+            self.time_thought = 0.0
+        
+    def _observe_objects(self, box):
+        """ Fills in the friends, foes and objects that this tank sees
+            within the given (xmin, xmax, ymin, ymax) box.
+        """
+        obs = self.observation
+        siz = self.width / 2.0
+        close = self.game.vision.query(*box)
+        if self.arrays is not None:
+            obs.objects = self.arrays.fill(self, close)
+        else:
+            friends, foes, objects = [], [], []
+            # Tanks come without a value, ammo and crumbs with their observation
+            for (o, item) in close:
+                if item is None:
+                    if o.team == self.team:
+                        if o is not self:
+                            friends.append((int(o._x+siz), int(o._y+siz)))
+                    else:
+                        foes.append((int(o._x+siz), int(o._y+siz), o._a))
                 else:
-                    obs.foes.append((int(o._x+siz), int(o._y+siz), o._a))
-            elif isinstance(o, Ammo):
-                obs.objects.append((o.cx, o.cy, "Ammo"))
-            elif isinstance(o, Crumb):
-                obs.objects.append((o.cx, o.cy, "Crumb"))
-        obs.cps = [(cp.cx,cp.cy,cp.team) for cp in self.game.controlpoints]
-        # Observe walls
+                    objects.append(item)
+            obs.friends, obs.foes, obs.objects = friends, foes, objects
+        self.game.stats.observed_objects += 1
+    
+    def _observe_walls(self, tile):
+        """ Fills in the walls around the given tile. """
+        obs = self.observation
         f = self.game.field
-        xj, yi = mx//f.tilesize, my//f.tilesize
+        xj, yi = tile
         # Only regenerate grid if we moved to another cell.
         if xj != self.grid_x or yi != self.grid_y:
-            gridrng = (rng/2+1)//f.tilesize
-            w,h = f.width, f.height
-            for oi,i in enumerate(range(int(yi-gridrng), int(yi+gridrng+1))):
-                for oj,j in enumerate(range(int(xj-gridrng), int(xj+gridrng+1))):
-                    if (i >= 0 and j >= 0 and i < h and j < w and
-                        f.wallgrid[i][j] == 0):
-                        obs.walls[oi][oj] = 0
-                    else:
-                        obs.walls[oi][oj] = 1
+            gridrng = int((self.game.settings.max_see/2+1)//f.tilesize)
+            n = gridrng * 2 + 1
+            padded = f.padded_wallgrid(gridrng)
+            if self.arrays is not None:
+                self.arrays.set_walls(self, xj, yi)
+            # Copy the rows of the window, unless we're outside the border
+            elif 0 <= yi and yi + n <= len(padded) and 0 <= xj and xj + n <= len(padded[0]):
+                for (row, padded_row) in zip(obs.walls, padded[yi:yi + n]):
+                    row[:] = padded_row[xj:xj + n]
+            else:
+                w,h = f.width, f.height
+                for oi,i in enumerate(range(yi-gridrng, yi+gridrng+1)):
+                    for oj,j in enumerate(range(xj-gridrng, xj+gridrng+1)):
+                        if (i >= 0 and j >= 0 and i < h and j < w and
+                            f.wallgrid[i][j] == 0):
+                            obs.walls[oi][oj] = 0
+                        else:
+                            obs.walls[oi][oj] = 1
             self.grid_x = xj
             self.grid_y = yi
+            self.game.stats.observed_walls += 1
         
-        last_clock = time.clock()
-        if self.brain is not None:
-            self.game._agent_call(self.brain.observe, args=[obs], team=self.team)
-        self.time_thought = time.clock() - last_clock
+    def _record_latency(self):
+        """ Adds the time that the brain took in this step to the histograms. """
+        latency = self.latency
+        latency['observe'].add(self.observe_ns)
+        latency['action'].add(self.action_ns)
+        latency['think'].add(self.observe_ns + self.action_ns)
         
     def get_action(self):
         ## Ask brain for action (or replay)
@@ -1429,8 +2443,14 @@ class Tank(GameObject):
             # print "i gots actions %s-%d"%('BLU' if self.team==TEAM_BLUE else 'RED',self.id)
             # print len(self.actions)
             (turn, speed, shoot) = self.actions.pop(0)
+        elif self.brain is None:
+            # Timeouts and debug drawing are handled for the whole team.
+            (turn, speed, shoot) = self.team_action
+            if self.record:
+                self.actions.append((turn,speed,shoot))
+            self._record_latency()
         else:
-            last_clock = time.clock()
+            last_clock = time.perf_counter_ns()
             
             def _act():
                 action = self.brain.action()
@@ -1439,7 +2459,9 @@ class Tank(GameObject):
                 return action
             
             (turn, speed, shoot) = self.game._agent_call(_act, default=(0,0,False), team=self.team)
-            self.time_thought += time.clock() - last_clock
+            self.action_ns = time.perf_counter_ns() - last_clock
+            self.time_thought += self.action_ns * 1e-9
+            self._record_latency()
             # Ignore action (NO-OP) if agent thought too long.
             if self.time_thought > self.game.settings.think_time:
                 (turn, speed, shoot) = (0,0,False)
@@ -1463,16 +2485,14 @@ class Tank(GameObject):
         self.observation.collided = False
         
     def collide(self, other):
-        if isinstance(other, Tank):
-            self.observation.collided = True
-        elif isinstance(other, Wall):
-            self.observation.collided = True
+        self.observation.collided = True
             
     def send_click(self, clicktuple):
         self.clicked.append(clicktuple)
             
 
 class Wall(GameObject):
+    __slots__ = ()
     def __init__(self, **kwargs):
         kwargs['graphic'] = None
         kwargs['movable'] = False
@@ -1480,12 +2500,14 @@ class Wall(GameObject):
         super(Wall, self).__init__(**kwargs)
 
 class ControlPoint(GameObject):
+    __slots__ = ('team', 'collided', 'touching')
     SIZE = 24
     def __init__(self,x,y):
         super(ControlPoint, self).__init__(x=x, y=y, width=ControlPoint.SIZE, height=ControlPoint.SIZE, shape=GameObject.SHAPE_CIRC, 
                                            solid=False, movable=False, graphic='cp_neutral')
         self.team = TEAM_NEUTRAL
         self.collided = [0, 0, 0]
+        self.touching = []
     
     def update(self):
         self.collided = [0, 0, 0]
@@ -1497,34 +2519,44 @@ class ControlPoint(GameObject):
             self.game.score_red -= 1
     
     def collide(self, other):
-        if isinstance(other, Tank):
-            self.collided[other.team] += 1
-            if self.game.settings.capture_mode == CAPTURE_MODE_NEUTRAL:
-                if not (self.collided[TEAM_RED] and self.collided[TEAM_BLUE]):
-                    self.team = other.team
+        self.touching.append(other.team)
+        
+    def tally(self):
+        """ Counts the tanks that touched this point during the
+            last substep, in the order that they touched it,
+            and updates the team that controls it.
+        """
+        collided = self.collided
+        capture_mode = self.game.settings.capture_mode
+        for team in self.touching:
+            collided[team] += 1
+            if capture_mode == CAPTURE_MODE_NEUTRAL:
+                if not (collided[TEAM_RED] and collided[TEAM_BLUE]):
+                    self.team = team
                 else:
                     self.team = TEAM_NEUTRAL
-            if self.game.settings.capture_mode == CAPTURE_MODE_FIRST:
-                if self.collided[self.team] == 0:
-                    self.team = other.team
-            elif self.game.settings.capture_mode == CAPTURE_MODE_MAJORITY:
-                if self.team != other.team and self.collided[other.team] == self.collided[self.team]:
+            if capture_mode == CAPTURE_MODE_FIRST:
+                if collided[self.team] == 0:
+                    self.team = team
+            elif capture_mode == CAPTURE_MODE_MAJORITY:
+                if self.team != team and collided[team] == collided[self.team]:
                     self.team = TEAM_NEUTRAL
-                elif self.collided[other.team] > self.collided[self.team]:
-                    self.team = other.team
-            
-            if self.team == TEAM_RED:
-                self.graphic = 'cp_red'
-            elif self.team == TEAM_BLUE:
-                self.graphic = 'cp_blue'
-            else:
-                self.graphic = 'cp_neutral'
-                
+                elif collided[team] > collided[self.team]:
+                    self.team = team
+        self.touching = []
+        
+        if self.team == TEAM_RED:
+            self.graphic = 'cp_red'
+        elif self.team == TEAM_BLUE:
+            self.graphic = 'cp_blue'
+        else:
+            self.graphic = 'cp_neutral'
 
         
 class Ammo(GameObject):
     """ Represents an ammo pack.
     """
+    __slots__ = ('pickedup', 'parent')
     SIZE    = 16
     GRAPHIC = 'ammo_full'
     def __init__(self,x,y):
@@ -1534,7 +2566,7 @@ class Ammo(GameObject):
         self.pickedup = False
     
     def collide(self, other):
-        if not self.pickedup and isinstance(other, Tank):
+        if not self.pickedup:
             if other.team == TEAM_RED:
                 self.game.stats.ammo_red += 1
             elif other.team == TEAM_BLUE:
@@ -1548,6 +2580,7 @@ class Crumb(Ammo):
         up, with no other purpose than being registered
         as picked up. Essentially a small ammo packet.
     """
+    __slots__ = ()
     SIZE = 4
     GRAPHIC = 'crumb'
 
@@ -1556,6 +2589,7 @@ class Fountain(GameObject):
         regular intervals, or when there are too few
         of its 'child' objects on the map.
     """
+    __slots__ = ('delay', 'countdown', 'children', 'initialized')
     MIN_CHILDREN = 1
     DELAY        = 10
     CHILD_CLASS  = Ammo
@@ -1569,6 +2603,7 @@ class Fountain(GameObject):
         super(Fountain, self).__init__(x=x, y=y, width=self.SIZE, height=self.SIZE, 
                                    shape=GameObject.SHAPE_RECT, solid=False, 
                                    movable=False, physical=False, graphic=self.GRAPHIC)
+        self.delay = self.DELAY
         self.countdown = -1
         self.children = []
         self.initialized = False
@@ -1582,37 +2617,47 @@ class Fountain(GameObject):
         if self.countdown > -1:
             self.countdown -= 1         
         if self.countdown == -1 and len(self.children) < self.MIN_CHILDREN:
-            self.countdown = self.DELAY
+            self.countdown = self.delay
         if self.countdown == 0:
             self.spawn_one()
             
     def remove_child(self, child):
         self.children.remove(child)
             
-    def spawn_one(self, attempts = 10):
+    def place(self, attempts = 10):
+        """ Picks a spot for a new child, returns its top-left corner,
+            or None if every attempt ended up in a wall.
+        """
         while attempts:
             (x,y) = self.SPREAD(self.x + self.width/2.0, self.y + self.height/2.0)
             f = self.game.field
             # Check if we're not spawning our object into a wall.
             (j,i) = int(x//f.tilesize), int(y//f.tilesize)
             if 0 <= i < f.height and 0 <= j < f.width and not f.wallgrid[i][j]:
-                c = self.CHILD_CLASS(x - self.CHILD_CLASS.SIZE/2.0, y - self.CHILD_CLASS.SIZE/2.0)
-                c.parent = self
-                self.children.append(c)
-                self.game._add_object(c)
-                return
+                return (x - self.CHILD_CLASS.SIZE/2.0, y - self.CHILD_CLASS.SIZE/2.0)
             attempts -= 1
+        return None
+            
+    def spawn_one(self, attempts = 10):
+        spot = self.place(attempts)
+        if spot is not None:
+            c = self.CHILD_CLASS(*spot)
+            c.parent = self
+            self.children.append(c)
+            self.game._add_object(c)
             
 class AmmoFountain(Fountain):
+    __slots__ = ()
     MIN_CHILDREN = 1
     CHILD_CLASS  = Ammo
     GRAPHIC      = 'ammo_empty'
             
     def added_to_game(self, game):
-        self.DELAY = self.game.settings.ammo_rate
+        self.delay = self.game.settings.ammo_rate
         super(AmmoFountain, self).added_to_game(game)
                 
 class CrumbFountain(Fountain):
+    __slots__ = ()
     MIN_CHILDREN = 200
     DELAY        = -1
     CHILD_CLASS  = Crumb
@@ -1621,6 +2666,7 @@ class CrumbFountain(Fountain):
         return x + self.game.random.gauss(0, 32), y + self.game.random.gauss(0, 32)
 
 class TankSpawn(GameObject):
+    __slots__ = ('team',)
     SIZE = 16
     def __init__(self,x=0, y=0, angle=0, team=TEAM_RED, brain=None):
         super(TankSpawn, self).__init__(x=x, y=y, angle=angle, width=TankSpawn.SIZE, height=TankSpawn.SIZE, 
@@ -1628,6 +2674,17 @@ class TankSpawn(GameObject):
         self.team = team
         self.graphic = 'spawn_red' if self.team == TEAM_RED else 'spawn_blue'
 
+# The objects that tanks, control points and ammo react to.
+Tank.COLLIDES_WITH         = (Tank, Wall)
+ControlPoint.COLLIDES_WITH = (Tank,)
+Ammo.COLLIDES_WITH         = (Tank,)
+
+# The objects that unpacked fields are made of, and their arguments, 
+# the field cache can't name anything else.
+Field.CACHED_CLASSES = dict((cls.__name__, cls) for cls in 
+                            (AmmoFountain, CrumbFountain, ControlPoint, TankSpawn, Wall))
+Field.CACHED_ARGS    = frozenset(('x', 'y', 'angle', 'team', 'width', 'height'))
+
 class Observation(object):
     def __init__(self):
         self.step       = 0     #: Current timestep
@@ -1636,13 +2693,14 @@ class Observation(object):
         self.walls      = []    #: Visible walls around the agent: a 2D binary array
         self.friends    = []    #: All/Visible friends: a list of (x,y,angle)-tuples
         self.foes       = []    #: Visible foes: a list of (x,y,angle)-tuples
-        self.cps        = []    #: Controlpoints: a list of (x,y,TEAM_RED/TEAM_BLUE)-tuples
+        self.cps        = ()    #: Controlpoints: a tuple of (x,y,TEAM_RED/TEAM_BLUE)-tuples
         self.objects    = []    #: Visible objects: a list of (x,y,type)-tuples
         self.ammo       = 0     #: Ammo count
         self.score      = (0,0) #: Current game score
         self.collided   = False #: Whether the agent has collided in the previous turn
         self.respawn_in = -1    #: How many timesteps left before this agent can move again.
         self.hit        = None  #: What the agent hit with its last shot. Can be None/TEAM_RED/TEAM_BLUE
+        self.arrays     = None  #: The stacked arrays of the team, with observation_type 'numpy'
         # The following properties are only set when
         # the renderer is enabled:
         self.selected = False   #: Indicates if the agent is selected in the UI
@@ -1655,10 +2713,63 @@ class Observation(object):
         return "== Observation ==\n" + "\n".join(('%s : %r'%(k.ljust(maxlen), v)) for (k,v) in items)
         
 
+class LazyObservation(Observation):
+    """ An observation that only computes the friends, foes and objects
+        that the agent sees, and the walls around it, when the agent first 
+        reads one of them in a step. They hold the same values as those of a
+        normal observation, which are computed for every step. 
+        Enable it with Settings(lazy_observations=True).
+    """
+    def __init__(self, tank):
+        Observation.__init__(self)
+        self._tank  = tank
+        self._walls = self.walls
+        self._box   = None
+        self._tile  = None
+        
+    def defer(self, box, tile):
+        """ Forgets the lazy fields of the previous step, they are
+            computed for the given box and tile when they are read.
+        """
+        d = self.__dict__
+        for name in ('friends', 'foes', 'objects'):
+            d.pop(name, None)
+        self._walls = d.pop('walls', self._walls)
+        self._box   = box
+        self._tile  = tile
+    
+    def resolve(self):
+        """ Computes all lazy fields that haven't been read yet. """
+        for name in ('friends', 'walls'):
+            getattr(self, name)
+    
+    def __getattr__(self, name):
+        # Only called for attributes that are not set
+        if name in ('friends', 'foes', 'objects'):
+            self._tank._observe_objects(self._box)
+        elif name == 'walls':
+            self.walls = self._walls
+            self._tank._observe_walls(self._tile)
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+        
+    def __getstate__(self):
+        self.resolve()
+        return dict((k, v) for (k, v) in self.__dict__.items() if not k.startswith('_'))
+        
+    def __str__(self):
+        self.resolve()
+        items = sorted((k, v) for (k, v) in self.__dict__.items() if not k.startswith('_'))
+        maxlen = max(len(k) for k,v in items)
+        return "== Observation ==\n" + "\n".join(('%s : %r'%(k.ljust(maxlen), v)) for (k,v) in items)
+        
+
 class ReplayData(object):
     """ Contains the replaydata for a game. """
     def __init__(self, game):
         self.settings = game.settings
+        self.seed = game.seed
         self.version = __version__
         self.actions_red  = [] # List of lists of red agents' actions
         self.actions_blue = [] # List of lists of blue agents' actions        
@@ -1670,5 +2781,28 @@ class ReplayData(object):
         g.run()
         return g
 
+
+class GameSnapshot(object):
+    """ The state of a game between two steps, see :meth:`Game.snapshot`.
+        It only contains numbers and tuples, and a reference to the field.
+    """
+    def __init__(self, game):
+        tanks = game.tanks
+        index = dict((tank, i) for (i, tank) in enumerate(tanks))
+        fountains = dict((f, i) for (i, f) in enumerate(game.fountains))
+        self.field = game.field #: The field of the game, it is not copied
+        self.step = game.step
+        self.score = (game.score_red, game.score_blue)
+        #: (x, y, angle, ammo, respawn_in, hit, collided) of each tank
+        self.tanks = tuple((t.x, t.y, t.angle, t.ammo, t.respawn_in, t.hit, t.observation.collided)
+                           for t in tanks)
+        #: The tanks in the order of the broadphase, to break ties in the same order
+        self.order = tuple(index[o] for o in game.broadphase_mov)
+        self.controlpoints = tuple(cp.team for cp in game.controlpoints) #: The team that holds each control point
+        self.fountains = tuple(f.countdown for f in game.fountains) #: The countdown of each fountain
+        #: (class, fountain, x, y) of each ammo pack and crumb that can be picked up
+        self.pickups = game._pickups(fountains)
+        self.random = game.random.getstate()
+
 if __name__ == "__main__":
     g = Game(verbose=True, rendered=True).run()
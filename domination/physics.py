@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+""" Vectorized physics for domination game engine.
+
+This module contains an alternative collision solver that keeps the positions
+and sizes of all objects in NumPy arrays. It produces the same collisions and
+collide() callbacks as :meth:`~domination.core.Game._substep`, but does the
+broadphase, overlap tests and separation in batches. You need numpy to use it,
+the game runs fine without it. Enable it with ``Game(physics='numpy')``.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Libraries
+import numpy as np
+
+### CLASSES ###
+
+class NumpyPhysics(object):
+    """ Struct-of-arrays collision solver.
+
+        Movable objects are gathered into arrays at the start of each substep,
+        static objects are only regathered when the game's static_version
+        changes (i.e. when ammo or crumbs are added or removed).
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.static_version = None
+        self.triu = {}
+
+    def _sync_static(self):
+        """ Rebuild the arrays that hold the static objects. """
+        stat = self.game.broadphase_stat
+        self.stat       = list(stat)
+        self.stat_x     = np.array([o._x for o in stat], dtype=float)
+        self.stat_y     = np.array([o._y for o in stat], dtype=float)
+        self.stat_r     = self.stat_x + np.array([o.width for o in stat], dtype=float)
+        self.stat_b     = self.stat_y + np.array([o.height for o in stat], dtype=float)
+        self.stat_w     = np.array([o.width for o in stat], dtype=float)
+        self.stat_h     = np.array([o.height for o in stat], dtype=float)
+        self.stat_circ  = np.array([o.shape == o.SHAPE_CIRC for o in stat], dtype=bool)
+        self.stat_solid = np.array([o.solid for o in stat], dtype=bool)
+        self.static_version = self.game.static_version
+
+    def substep(self):
+        """ Performs a single physics substep, equivalent to
+            :meth:`~domination.core.Game._substep`.
+        """
+        game = self.game
+        if self.static_version != game.static_version:
+            self._sync_static()
+        mov = game.broadphase_mov.objects
+        stat = self.stat
+        n = len(mov)
+        if n == 0:
+            return
+        x = np.array([o._x + o._dx for o in mov], dtype=float)
+        y = np.array([o._y + o._dy for o in mov], dtype=float)
+        w = np.array([o.width for o in mov], dtype=float)
+        h = np.array([o.height for o in mov], dtype=float)
+        # Sizes and shapes of movables followed by statics
+        W = np.concatenate((w, self.stat_w))
+        H = np.concatenate((h, self.stat_h))
+        C = np.concatenate(([o.shape == o.SHAPE_CIRC for o in mov], self.stat_circ))
+        S = np.concatenate(([o.solid for o in mov], self.stat_solid))
+        if n not in self.triu:
+            self.triu[n] = np.triu_indices(n, 1)
+        oi, oj = self.triu[n]
+        moved = np.ones(n, dtype=bool)
+        # Position of each object in the x-sorted broadphase order
+        order = np.arange(n)
+        rank = np.empty(n, dtype=int)
+        # Unordered pair of indices -> (o2, o1) in the orientation in which it was first found
+        pairs = {}
+        something_collided = True
+        iteration = game.SIMULATION_MAXITER
+        while something_collided and iteration > 0:
+            order = order[np.argsort(x[order], kind='stable')]
+            rank[order] = np.arange(n)
+            # Movable/movable candidates, i is always before j in the sort order.
+            i, j = order[oi], order[oj]
+            hit = ((moved[i] | moved[j]) &
+                   (x[j] < x[i] + w[i]) &
+                   (y[j] < y[i] + h[i]) & (y[i] < y[j] + h[j]))
+            i, j = i[hit], j[hit]
+            # Movable/static candidates, only for objects that moved
+            mv = np.nonzero(moved)[0]
+            mx, my = x[mv, None], y[mv, None]
+            mi, sj = np.nonzero((self.stat_r > mx) & (self.stat_x < mx + w[mv, None]) &
+                                (self.stat_y < my + h[mv, None]) & (my < self.stat_b))
+            mi = mv[mi]
+            a = np.concatenate((i, mi))
+            b = np.concatenate((j, n + sj))
+            moved[:] = False
+            if len(a) == 0:
+                break
+            X = np.concatenate((x, self.stat_x))
+            Y = np.concatenate((y, self.stat_y))
+            valid, p, px, py = separation(X[a], Y[a], W[a], H[a], C[a],
+                                          X[b], Y[b], W[b], H[b], C[b])
+            both_solid = S[a] & S[b]
+            # Reproduce the order in which the sweep finds the pairs: by the
+            # position of the first object, movables before statics.
+            second = np.where(b < n, rank[np.minimum(b, n-1)], b)
+            found = np.nonzero(valid)[0]
+            found = found[np.lexsort((second[found], rank[a[found]]))]
+            collisions = []
+            for o1, o2, solid, pen, dx, dy in zip(a[found].tolist(), b[found].tolist(),
+                                                  both_solid[found].tolist(), p[found].tolist(),
+                                                  px[found].tolist(), py[found].tolist()):
+                key = (o1, o2) if o1 < o2 else (o2, o1)
+                if key not in pairs:
+                    pairs[key] = (mov[o2] if o2 < n else stat[o2 - n], mov[o1])
+                if solid:
+                    collisions.append((pen, o1, o2, dx, dy))
+            something_collided = len(collisions) > 0
+            # Resolve collisions, deepest penetration first. This part is
+            # inherently sequential, but there are only few collisions.
+            collisions.sort(reverse=True, key=lambda c: c[0])
+            for (pen, o1, o2, dx, dy) in collisions:
+                if pen < 1:
+                    break
+                if o2 < n:
+                    if not moved[o1] and not moved[o2]:
+                        dx = dx / 2
+                        dy = dy / 2
+                        x[o1] += dx
+                        y[o1] += dy
+                        x[o2] -= dx
+                        y[o2] -= dy
+                        moved[o1] = True
+                        moved[o2] = True
+                elif not moved[o1]:
+                    x[o1] += dx
+                    y[o1] += dy
+                    moved[o1] = True
+            iteration -= 1
+        # Write back positions and broadphase order
+        for o, ox, oy in zip(mov, x.tolist(), y.tolist()):
+            o._x = ox
+            o._y = oy
+        mov[:] = [mov[k] for k in order.tolist()]
+        self.game._collide(sorted(pairs.values()))
+
+
+### FUNCTIONS ###
+
+def separation(ax, ay, aw, ah, acirc, bx, by, bw, bh, bcirc):
+    """ Vectorized version of :meth:`~domination.core.Game._compute_separation`.
+        Takes arrays describing the objects a and b of each pair, and
+        returns (valid, penetration, px, py), where px, py is the required
+        movement of a to separate it from b.
+    """
+    k = len(ax)
+    # Mixed pairs are solved with the rectangle as the first object
+    switched = acirc & ~bcirc
+    o1x = np.where(switched, bx, ax)
+    o1y = np.where(switched, by, ay)
+    o1w = np.where(switched, bw, aw)
+    o1h = np.where(switched, bh, ah)
+    o2x = np.where(switched, ax, bx)
+    o2y = np.where(switched, ay, by)
+    o2w = np.where(switched, aw, bw)
+    o2h = np.where(switched, ah, bh)
+    both_circ = acirc & bcirc
+    mixed = acirc != bcirc
+    # Find out if a circle hits a rect's corner
+    cx = o2x + o2w/2
+    cy = o2y + o2h/2
+    l, t = o1x, o1y
+    r, b = l + o1w, t + o1h
+    left, right, above, below = cx < l, cx > r, cy < t, cy > b
+    corner = mixed & ((left | right) & (above | below))
+    as_circles = both_circ | corner
+    pcx = np.where(both_circ, o1x, np.where(left, l, r))
+    pcy = np.where(both_circ, o1y, np.where(above, t, b))
+    pra = np.where(both_circ, o1w/2, 0.0)
+    # Separate Circle/Circle
+    md = pra + o2w / 2
+    dx = (pcx + pra) - (o2x + o2w/2)
+    dy = (pcy + pra) - (o2y + o2h/2)
+    ds = dx*dx + dy*dy
+    close = ds < 0.01
+    circ_valid = close | (ds < md*md)
+    d = np.sqrt(ds)
+    cp = np.where(close, 0.0, md - d)
+    f = cp/np.where(close, 1.0, d)
+    cpx = f * dx
+    cpy = f * dy
+    # Separate Rect/Rect, picking the first side with the smallest penetration
+    pts = np.stack((o1x + o1w - o2x, o1y + o1h - o2y, o2x + o2w - o1x, o2y + o2h - o1y))
+    rect_valid = (pts > 0).all(axis=0)
+    side = np.argmin(pts, axis=0)
+    rp = pts[side, np.arange(k)]
+    zero = np.zeros(k)
+    rpx = np.choose(side, (-rp, zero, rp, zero))
+    rpy = np.choose(side, (zero, -rp, zero, rp))
+    valid = np.where(as_circles, circ_valid, rect_valid)
+    p  = np.where(as_circles, cp, rp)
+    px = np.where(as_circles, cpx, rpx)
+    py = np.where(as_circles, cpy, rpy)
+    px = np.where(switched, -px, px)
+    py = np.where(switched, -py, py)
+    return valid, p, px, py
@@ -133,11 +133,11 @@ class Renderer(object):
     def render(self, game, wait = True, shooting_frame=-1):
         self.handle_events(game)
         if wait:
-            time.sleep(max(0, self.last_frame + SPF - time.clock()))
+            time.sleep(max(0, self.last_frame + SPF - time.perf_counter()))
         scr             = self.screen
         vp              = self.vp_surf
         ui              = self.ui_surf
-        self.last_frame = time.clock()
+        self.last_frame = time.perf_counter()
         scr.fill((71,71,71))
         ## MAP
         vp.blit(self.mapsurface,(0,0))
@@ -279,7 +279,7 @@ class Renderer(object):
         # Flip buffers
         pg.display.flip()
         # Compute render time
-        self.render_time = time.clock() - self.last_frame
+        self.render_time = time.perf_counter() - self.last_frame
 
     def handle_events(self, game):
         for event in pg.event.get():
@@ -41,6 +41,15 @@ def callfunc(tup):
     (ob, fun, args, kwds) = tup
     return getattr(ob, fun)(*args, **kwds)
 
+def game_seed(master, *keys):
+    """ Derives the seed of a single game from the master seed and 
+        the keys that identify the game, independent of the process.
+        
+        >>> game_seed(1, 'red.py', 'blue.py', 0)
+        366520373
+    """
+    return int(hashlib.sha1(repr((master,) + keys).encode('utf-8')).hexdigest()[:8], 16)
+
 ### CLASSES ###
 
 class MatchInfo(object):
@@ -75,6 +84,9 @@ class Scenario(object):
     SWAP_TEAMS        = True   #: Repeat each run with blue/red swapped
     DRAW_MARGIN       = 0.05
     SCORING           = SCORING_LINEAR
+    REUSE_NAMESPACE   = False  #: Run agents' module code once per match instead of every game
+    SEED              = None   #: Master seed, each game gets its own seed derived from it
+    FIELD_CACHE       = None   #: Directory to cache unpacked fields in, see :attr:`~domination.core.Field.CACHE_DIR`
 
     MULTITHREADING = True
             
@@ -100,12 +112,14 @@ class Scenario(object):
     """ You shouldn't have to override any
         of the methods below, but you may.
     """ 
-    def _single(self, red, blue, matchinfo=None, rendered=False, verbose=False):
+    def _single(self, red, blue, matchinfo=None, rendered=False, verbose=False, teams=None, seed=None):
         """ Runs a single game, returns results, called repeatedly
-            by :meth:`Scenario._multi`.
+            by :meth:`Scenario._multi`. If a (red, blue) tuple of teams
+            is given, those play instead of new teams loaded from red and blue.
+            The seed is used for the field and the game.
         """
         if self.GENERATOR is not None:
-            self.FIELD = self.GENERATOR.generate()
+            self.FIELD = self.GENERATOR.generate(seed=seed)
         self.before_game()
         # Open blobs for reading if we can find 'em
         red_blob = os.path.splitext(red)[0] + '_blob'
@@ -121,13 +135,27 @@ class Scenario(object):
         if os.path.exists(blue_blob):
             blue_init['blob'] = open(blue_blob,'rb')
         
-        # Run the game
-        game = core.Game(red, blue, 
-                    red_init=red_init, blue_init=blue_init,
-                    field=self.FIELD, settings=self.SETTINGS,
-                    record=True, verbose=verbose, rendered=False)
+        if teams is not None:
+            red, blue = teams
+            red.init_kwargs = red_init
+            blue.init_kwargs = blue_init
+        # Run the game, on a fixed field the last game is set up again, 
+        # which only has to put the objects of the field back in place.
+        game = getattr(self, '_game', None)
+        if game is None or game.field is not self.FIELD or game.settings is not self.SETTINGS or rendered:
+            game = core.Game(red, blue, 
+                        red_init=red_init, blue_init=blue_init,
+                        field=self.FIELD, settings=self.SETTINGS,
+                        record=True, verbose=verbose, rendered=False, seed=seed)
+        else:
+            game.red = red if isinstance(red, core.Team) else core.Team(red, red_init)
+            game.blue = blue if isinstance(blue, core.Team) else core.Team(blue, blue_init)
+            game.verbose = verbose
+            game.seed = seed
         if rendered:
             game.add_renderer()
+        else:
+            self._game = game
         game.run()
         # Close the blobs
         if 'blob' in red_init:
@@ -143,6 +171,8 @@ class Scenario(object):
             Copies the agents to a temporary subfolder so that
             they can write to a unique blob.
         """
+        if self.FIELD_CACHE is not None:
+            core.Field.CACHE_DIR = self.FIELD_CACHE
         # Create a folder for the agent copies
         uid = uuid.uuid4().hex[:8]
         path = os.path.join(output_folder,'matchups')
@@ -163,6 +193,12 @@ class Scenario(object):
         if os.path.exists(blue_blob):
             shutil.copyfile(blue_blob, os.path.splitext(newblue)[0] + '_blob')
         
+        # The same teams play all games, so they can keep their namespace
+        teams = None
+        if self.REUSE_NAMESPACE:
+            teams = (core.Team(newred, reuse_namespace=True),
+                     core.Team(newblue, reuse_namespace=True))
+        
         # Run the matches
         gameinfo = []
         for i in range(self.REPEATS):
@@ -171,7 +207,9 @@ class Scenario(object):
             elif self.SCORING == SCORING_LINEAR:
                 score_weight = 2.0 * i / (self.REPEATS - 1)
             matchinfo = MatchInfo(self.REPEATS, i, hash((red, blue)), score_weight)
-            gameinfo.append((red, blue) + self._single(newred, newblue, matchinfo, rendered, verbose))
+            seed = None if self.SEED is None else game_seed(self.SEED, red, blue, i)
+            gameinfo.append((red, blue) + self._single(newred, newblue, matchinfo, rendered, verbose, teams, seed))
+        self._game = None
         return gameinfo
         
     def _multi(self, games, output_folder, rendered=False, verbose=False):
@@ -203,13 +241,20 @@ class Scenario(object):
         """
         # Find the prefix from the agent paths
         all_agents = set(a for g in gameinfo for a in (g[0], g[1]))
-        prefix = os.path.commonprefix(all_agents).rfind('/') + 1
+        prefix = os.path.commonprefix(list(all_agents)).rfind('/') + 1
         
         # Configure the CSV
-        fieldnames = ('red_file', 'blue_file', 'score_red', 'score_blue', 'score', 
-                      'weight', 'points_red', 'points_blue', 'steps', 'ammo_red', 'ammo_blue')
+        fieldnames = ('red_file', 'blue_file', 'seed', 'score_red', 'score_blue', 'score', 
+                      'weight', 'points_red', 'points_blue', 'steps', 'ammo_red', 'ammo_blue',
+                      'think_time_red', 'think_time_blue') + tuple('%s_time'%phase for phase in core.PHASES)
         csvf = csv.DictWriter(open(os.path.join(output_folder, 'games.csv'),'w'), fieldnames, extrasaction='ignore')
         csvf.writerow(dict(list(zip(fieldnames, fieldnames))))
+        
+        # And one for the think times of every agent, in seconds
+        timingnames = ('game', 'file', 'team', 'id', 'think_p50', 'think_p99', 
+                       'observe_p50', 'observe_p99', 'action_p50', 'action_p99')
+        timingf = csv.DictWriter(open(os.path.join(output_folder, 'timings.csv'),'w'), timingnames)
+        timingf.writerow(dict(list(zip(timingnames, timingnames))))
 
         # Open other files
         zipf = zipfile.ZipFile(os.path.join(output_folder, 'replays.zip'),'w', zipfile.ZIP_DEFLATED, True)
@@ -249,10 +294,19 @@ class Scenario(object):
             s = copy.copy(stats.__dict__)
             s.update([('red_file',r), 
                       ('blue_file',b), 
+                      ('seed', replay.seed),
                       ('weight', matchinfo.score_weight), 
                       ('points_red', points_red), 
                       ('points_blue', points_blue)])
+            s.update(('%s_time'%phase, t) for (phase, t) in stats.phase_time.items())
             csvf.writerow(s)
+            for ((team, agent_id), latency) in sorted(stats.latency.items()):
+                row = {'game': i, 'file': b if team == core.TEAM_BLUE else r, 
+                       'team': 'blue' if team == core.TEAM_BLUE else 'red', 'id': agent_id}
+                for (kind, histogram) in latency.items():
+                    row[kind + '_p50'] = histogram.percentile(50)
+                    row[kind + '_p99'] = histogram.percentile(99)
+                timingf.writerow(row)
             rbase = os.path.splitext(os.path.basename(r))[0]
             bbase = os.path.splitext(os.path.basename(b))[0]
             zipf.writestr('replay_%04d_%s_vs_%s.pickle'%(i, rbase, bbase), pickle.dumps(replay, pickle.HIGHEST_PROTOCOL))
@@ -285,16 +339,18 @@ class Scenario(object):
         
     
     @classmethod
-    def test(cls, red, blue):
+    def test(cls, red, blue, seed=None):
         """ Test this scenario, this will run a single
             game and render it, so you can verify the
-            FIELD and SETTINGS.
+            FIELD and SETTINGS. Pass the seed of a game from
+            a tournament's games.csv to play that game again.
             
             :param red:  Path to red agent
             :param blue: Path to blue agent
+            :param seed: The seed of the game
         """
         scen = cls()
-        scen._single(red, blue, None, rendered=True, verbose=True)
+        scen._single(red, blue, None, rendered=True, verbose=True, seed=seed)
     
     @classmethod
     def one_on_one(cls, output_folder, red, blue, rendered=False, verbose=False):
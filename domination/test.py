@@ -9,6 +9,10 @@ working properly. This includes saving fields and replays.
 
 # Python Imports
 import os
+import hashlib
+import time
+import random
+import operator
 import unittest
 import shutil
 import tempfile
@@ -41,6 +45,28 @@ class Agent(object):
         pass
 """
 
+TEAM_AGENT = """
+class TeamBrain(object):
+    NAME = "teamagent"
+    
+    def __init__(self, num_agents, team, settings=None, **kwargs):
+        self.num_agents = num_agents
+        self.observed = 0
+    
+    def observe(self, observations):
+        assert len(observations) == self.num_agents
+        self.observed += 1
+    
+    def action(self):
+        return [(-pi + rand()*2*pi, 100, True)] * self.num_agents
+    
+    def debug(self, surface):
+        pass
+    
+    def finalize(self, interrupted=False):
+        pass
+"""
+
 SMALL_FIELD = """
 w w w w w w w w w w w w w w w w w w w
 w _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ w
@@ -85,6 +111,16 @@ class TestDominationGame(unittest.TestCase):
         teamb.setname(team.fullname())
         self.assertEqual(team.fullname(), teamb.fullname())
         
+    def test_team_namespace(self):
+        agent = "loaded = []\n" + RANDOM_AGENT + "\nloaded.append(Agent)\n"
+        settings = core.Settings(max_steps=5)
+        red = core.Team(agent, reuse_namespace=True)
+        blue = core.Team(agent)
+        for i in range(3):
+            core.Game(red=red, blue=blue, settings=settings, rendered=False, verbose=False).run()
+        self.assertEqual(len(red.namespace['loaded']), 1)
+        self.assertTrue(blue.namespace is None)
+        
     def test_render(self):
         try:
             import pygame
@@ -103,6 +139,91 @@ class TestDominationGame(unittest.TestCase):
             self.assertEqual(len(f.find(core.Field.CONTROL)), 3)
             self.assertEqual(len(f.find(core.Field.AMMO)), 6)
         f3 = core.Field.from_string(SMALL_FIELD)
+
+    def test_nav_mesh(self):
+        f = core.FieldGenerator(width=61, height=36).generate(seed=1)
+        walls = [rect_offset(w, 7 - 0.001) for w in f.wallrects]
+        grid = RectGrid(walls)
+        points = list(f.mesh)
+        for p0 in points[::3]:
+            for p1 in points:
+                self.assertEqual(grid.line_hits(p0, p1), any(line_intersects_rect(p0, p1, w) for w in walls))
+        for (n1, edges) in f.mesh.items():
+            for n2 in edges:
+                self.assertFalse(grid.line_hits(n1, n2))
+                self.assertEqual(f.mesh[n1][n2], point_dist(n1, n2))
+
+    def test_field_cache(self):
+        folder = tempfile.mkdtemp()
+        f = core.FieldGenerator().generate(seed=1)
+        mesh = f.mesh
+        try:
+            core.Field.CACHE_DIR = folder
+            copied = pickle.loads(pickle.dumps(f))
+            self.assertTrue(f.mesh is mesh)
+            copied.unpack()
+            self.assertFalse(os.path.exists(copied._cache_path()))
+            copied.mesh
+            self.assertTrue(os.path.exists(copied._cache_path()))
+            cached = pickle.loads(pickle.dumps(f))
+            self.assertEqual(cached.mesh, mesh)
+            self.assertEqual(cached.wallrects, f.wallrects)
+            self.assertEqual(cached.get_objects()[0].x, f.get_objects()[0].x)
+            # Files that don't hold plain field data are ignored
+            for data in ['not json', '[[], [["Game", {}]], [], [], []]', pickle.dumps(f).decode('latin-1')]:
+                with open(f._cache_path(), 'w') as fh:
+                    fh.write(data)
+                other = pickle.loads(pickle.dumps(f))
+                self.assertEqual(other.wallrects, f.wallrects)
+                self.assertEqual(len(other.get_objects()), len(f.get_objects()))
+        finally:
+            core.Field.CACHE_DIR = None
+            shutil.rmtree(folder)
+
+    def test_seed(self):
+        generator = core.FieldGenerator(num_crumbsource=1)
+        field = generator.generate(seed=3)
+        self.assertEqual(field, generator.generate(seed=3))
+        settings = core.Settings(max_steps=50)
+        state = random.getstate()
+        games = [core.Game(red=RANDOM_AGENT, blue=RANDOM_AGENT, settings=settings, field=field,
+                           record=True, rendered=False, verbose=False, seed=7).run() for i in range(2)]
+        self.assertEqual([(t.x, t.y) for t in games[0].tanks], [(t.x, t.y) for t in games[1].tanks])
+        self.assertEqual(games[0].replay.seed, 7)
+        # The agents draw from a generator of their own, the global one is left alone
+        self.assertEqual(random.getstate(), state)
+
+    def test_rerun(self):
+        field = core.FieldGenerator(num_crumbsource=1).generate(seed=3)
+        settings = core.Settings(max_steps=50)
+        game = core.Game(red=RANDOM_AGENT, blue=RANDOM_AGENT, settings=settings, field=field,
+                         record=True, rendered=False, verbose=False, seed=7)
+        fresh = core.Game(red=RANDOM_AGENT, blue=RANDOM_AGENT, settings=settings, field=field,
+                          record=True, rendered=False, verbose=False, seed=8).run()
+        game.run()
+        objects = game.objects
+        log = game.log
+        # The objects are reused with a new seed too, the crumbs are spread anew.
+        game.seed = 8
+        game.run()
+        self.assertTrue(objects[0] is game.objects[0])
+        self.assertFalse(log is game.log)
+        self.assertEqual([(o.uid, o.x, o.y) for o in game.objects], [(o.uid, o.x, o.y) for o in fresh.objects])
+        self.assertEqual(game.replay.actions_red, fresh.replay.actions_red)
+        self.assertEqual((game.score_red, game.score_blue), (fresh.score_red, fresh.score_blue))
+
+    def test_shared_field(self):
+        settings = core.Settings(max_steps=5)
+        game = core.Game(settings=settings, rendered=False, verbose=False)
+        game.run()
+        (rects, grid, mesh) = game.field.frozen()
+        for tank in game.tanks:
+            self.assertTrue(tank.brain.mesh is mesh)
+            self.assertTrue(tank.brain.grid is grid)
+            self.assertFalse(tank.brain.settings is game.settings)
+        self.assertRaises(TypeError, operator.setitem, mesh, (0, 0), {})
+        self.assertEqual(thaw(mesh), game.field.mesh)
+        self.assertEqual(thaw(grid), game.field.wallgrid)
                 
     def test_string_agent(self):
         game = core.Game(red=RANDOM_AGENT, 
@@ -110,6 +231,67 @@ class TestDominationGame(unittest.TestCase):
                          rendered=False)
         game.run()
     
+    def test_team_brain(self):
+        settings = core.Settings(max_steps=50)
+        game = core.Game(red=TEAM_AGENT, blue=RANDOM_AGENT, settings=settings,
+                         record=True, rendered=False, verbose=False)
+        game.run()
+        self.assertFalse(game.red.raised_exception)
+        ((brain, tanks),) = game.team_brains
+        self.assertEqual(brain.observed, 50)
+        self.assertEqual(tanks, game.tanks_red)
+        self.assertTrue(all(tank.brain is None for tank in tanks))
+        self.assertEqual(len(game.replay.actions_red[0]), 50)
+    
+    def test_timings(self):
+        settings = core.Settings(max_steps=50)
+        game = core.Game(red=RANDOM_AGENT, blue=TEAM_AGENT, settings=settings,
+                         rendered=False, verbose=False)
+        game.run()
+        self.assertEqual(sorted(game.stats.phase_time), sorted(core.PHASES))
+        self.assertTrue(game.stats.phase_time['substep'] > 0)
+        self.assertEqual(len(game.stats.latency), len(game.tanks))
+        for latency in game.stats.latency.values():
+            self.assertEqual(latency['think'].count, 50)
+            self.assertTrue(0 < latency['think'].percentile(50) <= latency['think'].percentile(99))
+    
+    def test_advance(self):
+        settings = core.Settings(max_steps=20)
+        game = core.Game(settings=settings, rendered=False, verbose=False)
+        for i in range(2):
+            observations = game.reset()
+            self.assertEqual(len(observations), len(game.tanks))
+            self.assertTrue(all(tank.brain is None for tank in game.tanks))
+            total, done = 0, False
+            while not done:
+                (observations, (red, blue), done) = game.advance([(0, 40, True)] * len(game.tanks))
+                total += red - blue
+            self.assertEqual(game.step, settings.max_steps)
+            self.assertEqual(total, game.score_red - game.score_blue)
+            self.assertEqual(game.state, core.Game.STATE_ENDED)
+        self.assertRaises(Exception, game.advance, [(0, 0, False)] * len(game.tanks))
+    
+    def test_snapshot(self):
+        field = core.FieldGenerator(num_crumbsource=1).generate()
+        settings = core.Settings(max_steps=100)
+        game = core.Game(field=field, settings=settings, rendered=False, verbose=False)
+        game.reset()
+        actions = [(0.3, 40, True)] * len(game.tanks)
+        for i in range(20):
+            game.advance(actions)
+        snapshot = game.snapshot()
+        def play(game):
+            for i in range(30):
+                (observations, rewards, done) = game.advance(actions)
+            return (game.snapshot().__dict__, [(obs.loc, obs.friends, obs.foes, obs.objects) for obs in observations])
+        first = play(game)
+        game.restore(snapshot)
+        self.assertEqual(play(game), first)
+        sim = core.Game(field=field, settings=settings, rendered=False, verbose=False)
+        sim.restore(snapshot)
+        self.assertTrue(all(tank.brain is None for tank in sim.tanks))
+        self.assertEqual(play(sim), first)
+    
     def test_replay(self):
         settings = core.Settings(max_steps=200)
         for i in range(40):
@@ -119,6 +301,322 @@ class TestDominationGame(unittest.TestCase):
             replaygame.run()
             self.assertEqual(replaygame.score_red, game.score_red)
             
+    def test_object_order(self):
+        game = core.Game(settings=core.Settings(max_steps=5), rendered=False, verbose=False)
+        game.run()
+        # Objects sort like the MD5 digests of their uids, as in older versions
+        digest = lambda o: hashlib.md5(str(o.uid).encode()).digest()
+        self.assertEqual(sorted(game.objects), sorted(game.objects, key=digest))
+        # Their uids count up, ammo that was picked up leaves gaps
+        uids = [o.uid for o in game.objects]
+        self.assertEqual(uids, sorted(set(uids)))
+        self.assertTrue(all(isinstance(uid, int) for uid in uids))
+            
+    def test_sweep_and_prune(self):
+        rng = random.Random(1)
+        sap = core.SweepAndPrune()
+        objects = [core.Tank(x=rng.uniform(0, 200), y=0) for _ in range(40)]
+        def check():
+            xs = [o._x for o in sap]
+            self.assertEqual(xs, sorted(xs))
+            objs = sap.objects
+            found = set(frozenset((id(objs[i]), id(objs[j]))) for (i, j) in sap.overlaps())
+            brute = set(frozenset((id(a), id(b))) for a in objs for b in objs 
+                        if a is not b and a._x < b._x + b.width and b._x < a._x + a.width)
+            self.assertEqual(found, brute)
+        for o in objects:
+            sap.add(o)
+        check()
+        for _ in range(20):
+            for o in rng.sample(objects, 10):
+                o._x += rng.uniform(-15, 15)
+            sap.update()
+            check()
+        for o in objects[::3]:
+            sap.remove(o)
+        self.assertEqual(len(sap), len(objects) - len(objects[::3]))
+        check()
+
+    def test_static_grid(self):
+        rng = random.Random(2)
+        grid = core.StaticGrid(10, 8, 16)
+        # Random walls, walls on the tile edges and walls outside of the field.
+        walls = [core.Wall(x=rng.uniform(-20, 180), y=rng.uniform(-20, 140),
+                           width=rng.choice([4, 16, 40]), height=rng.choice([4, 16, 40]))
+                 for _ in range(60)]
+        walls += [core.Wall(x=16*i, y=16*i, width=16, height=16) for i in range(8)]
+        walls += [core.Wall(x=-50, y=-50), core.Wall(x=300, y=300), core.Wall(x=300, y=-50)]
+        def check():
+            self.assertEqual([o._x for o in grid], sorted(o._x for o in grid))
+            for _ in range(50):
+                xmin, ymin = rng.uniform(-40, 200), rng.uniform(-40, 160)
+                xmax, ymax = xmin + rng.uniform(0, 50), ymin + rng.uniform(0, 50)
+                entries = grid.query(xmin, xmax, ymin, ymax)
+                self.assertEqual(entries, sorted(entries))
+                found = [e[2] for e in entries]
+                self.assertEqual(len(set(map(id, found))), len(found))
+                for o in grid:
+                    if (o._x <= xmax and xmin <= o._x + o.width and
+                        o._y <= ymax and ymin <= o._y + o.height):
+                        self.assertTrue(any(o is f for f in found))
+            # Objects off the field end up on the border tiles.
+            for o in grid:
+                if o._x > 200 and o._y > 200:
+                    self.assertTrue(any(o is e[2] for e in grid.query(159, 159, 127, 127)))
+                if o._x < 0 and o._y < 0:
+                    self.assertTrue(any(o is e[2] for e in grid.query(0, 0, 0, 0)))
+        for o in walls:
+            grid.add(o)
+        self.assertEqual(len(grid), len(walls))
+        check()
+        # Removing objects clears the cached queries
+        removed = walls[::4]
+        seqs = [grid.seqs[id(o)] for o in removed]
+        order = list(grid)
+        for o in removed:
+            grid.remove(o)
+        self.assertEqual(len(grid), len(walls) - len(removed))
+        self.assertFalse(any(o is e[2] for o in removed for e in grid.query(-100, 400, -100, 400)))
+        check()
+        # Putting them back with their old sequence numbers restores the order
+        for o, seq in reversed(list(zip(removed, seqs))):
+            grid.add(o, seq=seq)
+        self.assertEqual(list(map(id, grid)), list(map(id, order)))
+        self.assertEqual(len(grid.query(-100, 400, -100, 400)), len(walls))
+        check()
+
+    def test_sleeping(self):
+        field = core.Field.from_string(SMALL_FIELD)
+        settings = core.Settings(max_steps=30)
+        def play(sleep):
+            core.Game.SIMULATION_SLEEP = sleep
+            try:
+                game = core.Game(settings=settings, field=field, rendered=False, verbose=False)
+                game.reset()
+                states = []
+                for step in range(20):
+                    # Drive around for a bit, then stand still
+                    obs, _, _ = game.advance([(0.5, 40 if step < 5 else 0, False)] * len(game.tanks))
+                    if step == 12:
+                        self.assertEqual(all(t._sleeping for t in game.tanks), sleep)
+                        # Dropping ammo on a tank wakes it up, and it gets picked up
+                        tank = game.tanks[0]
+                        game._add_object(core.Ammo(tank.x, tank.y))
+                        self.assertFalse(tank._still)
+                    states.append([(t.x, t.y, t.angle, t.ammo, o.collided)
+                                   for (t, o) in zip(game.tanks, obs)])
+                states.append([(cp.team, cp.graphic) for cp in game.controlpoints])
+                return game, states
+            finally:
+                core.Game.SIMULATION_SLEEP = True
+        game, states = play(True)
+        self.assertEqual(states, play(False)[1])
+        self.assertTrue(all(t._sleeping for t in game.tanks))
+        # Sleeping tanks keep reporting their contacts
+        self.assertTrue(any(collided for (_, _, _, _, collided) in states[-2]))
+        self.assertEqual(sum(t.ammo for t in game.tanks), settings.ammo_amount)
+        # Pushing a sleeping tank wakes it up
+        (pusher, sleeper) = game.tanks[:2]
+        self.assertEqual(pusher._x, sleeper._x)
+        y = sleeper._y
+        pusher._dy = 3
+        game._substep()
+        self.assertFalse(sleeper._still)
+        self.assertNotEqual(sleeper._y, y)
+
+    def test_vision_grid(self):
+        rng = random.Random(3)
+        grid = core.VisionGrid(32)
+        # Random objects, objects on the cell edges, at negative coordinates
+        # and objects larger than a cell.
+        objects = [core.Tank(x=rng.uniform(-50, 250), y=rng.uniform(-50, 250)) for _ in range(50)]
+        objects += [core.Ammo(x=32*i, y=32*(i % 3)) for i in range(-2, 6)]
+        objects += [core.Wall(x=-40, y=60, width=100, height=20), core.Wall(x=90, y=-70, width=20, height=90)]
+        items = [(o, i) for (i, o) in enumerate(objects)]
+        grid.build(items)
+        self.assertEqual(grid.maxsize, 100)
+        bounds = [(rng.uniform(-100, 250), rng.uniform(-100, 250)) for _ in range(100)]
+        bounds += [(32*i, 32*j) for i in range(-2, 4) for j in range(-2, 4)]
+        for (xmin, ymin) in bounds:
+            for size in (0, 32, 60):
+                xmax, ymax = xmin + size, ymin + size
+                brute = [(o, v) for (o, v) in items if (o._x <= xmax and o._x + o.width > xmin and
+                                                        ymin < o._y + o.height and o._y < ymax)]
+                self.assertEqual(grid.query(xmin, xmax, ymin, ymax), brute)
+        grid.build([])
+        self.assertEqual(grid.query(-100, 100, -100, 100), [])
+
+    def test_collision_handlers(self):
+        calls = []
+        class RecordingTank(core.Tank):
+            __slots__ = ()
+            def collide(self, other):
+                calls.append((self, other))
+        class RecordingWall(core.Wall):
+            __slots__ = ()
+            def collide(self, other):
+                calls.append((self, other))
+        class RecordingAmmo(core.Ammo):
+            __slots__ = ()
+            def collide(self, other):
+                calls.append((self, other))
+        field = core.Field.from_string(SMALL_FIELD)
+        game = core.Game(field=field, rendered=False, verbose=False)
+        game.reset()
+        red, blue = RecordingTank(team=core.TEAM_RED), RecordingTank(team=core.TEAM_BLUE)
+        wall, ammo = RecordingWall(), RecordingAmmo(0, 0)
+        game._collide([(red, blue), (red, wall), (wall, blue), (ammo, wall), (wall, ammo), (ammo, red)])
+        # Walls react to nothing, ammo only to tanks, and tanks to tanks and walls.
+        self.assertEqual(calls, [(red, blue), (blue, red), (red, wall), (blue, wall), (ammo, red)])
+        # Control points count the tanks touching them after all pairs are handled.
+        cp = game.controlpoints[0]
+        game._collide([(cp, red), (blue, cp), (cp, blue)])
+        self.assertEqual((cp.team, cp.collided, cp.touching), (core.TEAM_BLUE, [1, 2, 0], []))
+
+    def test_control_point_tally(self):
+        R, B, N = core.TEAM_RED, core.TEAM_BLUE, core.TEAM_NEUTRAL
+        # (team before, teams touching in order, team after)
+        cases = {
+            core.CAPTURE_MODE_NEUTRAL:  [(N, [R], R), (R, [R, B], N), (B, [R, R], R), (R, [B, B, R], N)],
+            core.CAPTURE_MODE_FIRST:    [(N, [R, B], R), (B, [R, B], R), (B, [B, R], B), (N, [B, R, R], B)],
+            core.CAPTURE_MODE_MAJORITY: [(N, [R, B], N), (N, [R, B, B], B), (R, [B, R, R], R), (B, [R], R)]
+        }
+        field = core.Field.from_string(SMALL_FIELD)
+        for (mode, tallies) in cases.items():
+            game = core.Game(settings=core.Settings(capture_mode=mode), field=field,
+                             rendered=False, verbose=False)
+            game.reset()
+            cp = game.controlpoints[0]
+            for (before, touching, after) in tallies:
+                cp.team = before
+                cp.update()
+                for team in touching:
+                    cp.collide(core.Tank(team=team))
+                cp.tally()
+                self.assertEqual(cp.team, after)
+                self.assertEqual(cp.collided[R] + cp.collided[B], len(touching))
+                self.assertEqual(cp.graphic, {R: 'cp_red', B: 'cp_blue', N: 'cp_neutral'}[after])
+            # Tanks that touch the point in later substeps of the same step add up.
+            cp.team = N
+            cp.update()
+            for team in [R, R, B, B]:
+                cp.collide(core.Tank(team=team))
+                cp.tally()
+            self.assertEqual(cp.team, {core.CAPTURE_MODE_NEUTRAL: N, core.CAPTURE_MODE_FIRST: R,
+                                       core.CAPTURE_MODE_MAJORITY: N}[mode])
+
+    def test_old_replay(self):
+        settings = core.Settings(max_steps=100)
+        game = core.Game(settings=settings, record=True, rendered=False, verbose=False)
+        game.run()
+        # Replays from before these settings were added don't have them.
+        del game.replay.settings.observation_type
+        del game.replay.settings.lazy_observations
+        replay = pickle.loads(pickle.dumps(game.replay))
+        self.assertEqual(replay.settings.observation_type, 'python')
+        self.assertEqual(replay.settings.lazy_observations, False)
+        replaygame = core.Game(replay=replay, rendered=False, verbose=False)
+        replaygame.run()
+        self.assertEqual(replaygame.score_red, game.score_red)
+            
+    def test_numpy_physics(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the numpy physics test.")
+            return
+        settings = core.Settings(max_steps=100)
+        field = core.FieldGenerator(num_crumbsource=1).generate()
+        game = core.Game(red=RANDOM_AGENT, blue=RANDOM_AGENT, settings=settings, field=field,
+                         record=True, rendered=False, verbose=False)
+        game.run()
+        replaygame = core.Game(replay=game.replay, rendered=False, verbose=False, physics='numpy')
+        replaygame.run()
+        self.assertEqual(replaygame.score_red, game.score_red)
+        self.assertEqual([(t.x, t.y) for t in replaygame.tanks], [(t.x, t.y) for t in game.tanks])
+
+    def test_numpy_observations(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the numpy observations test.")
+            return
+        settings = core.Settings(max_steps=50, observation_type='numpy')
+        game = core.Game(red=RANDOM_AGENT, blue=RANDOM_AGENT, settings=settings,
+                         rendered=False, verbose=False)
+        game.run()
+        for tank in game.tanks:
+            obs = tank.observation
+            self.assertEqual(obs.walls.shape, obs.arrays.walls.shape[1:])
+            self.assertEqual(len(obs.friends), obs.arrays.num_friends[tank.id])
+            self.assertEqual(obs.cps.shape, (len(game.controlpoints), 3))
+            self.assertTrue((obs.loc == obs.arrays.loc[tank.id]).all())
+            self.assertFalse(obs.walls.flags.writeable)
+        # The default agent plays with them too
+        game = core.Game(settings=settings, rendered=False, verbose=False, hard_errors=True)
+        game.run()
+        self.assertFalse(game.red.raised_exception or game.blue.raised_exception)
+
+    def test_vecgame(self):
+        try:
+            import numpy
+        except ImportError:
+            print("It looks like you don't have numpy installed, skipping the vectorized game test.")
+            return
+        from .vecgame import VecGame
+        vec = VecGame(4, settings=core.Settings(max_steps=20))
+        obs = vec.reset()
+        self.assertEqual(obs['loc'].shape, (4, len(vec.games[0].tanks), 2))
+        games = list(vec.games)
+        for step in range(30):
+            actions = numpy.zeros((4, len(vec.games[0].tanks), 3))
+            actions[:, :, 1] = 40
+            obs, rewards, dones = vec.step(actions)
+            self.assertEqual(rewards.shape, (4, 2))
+            self.assertEqual(dones.all(), step == 19)
+            for (i, game) in enumerate(vec.games):
+                for (k, tank) in enumerate(game.tanks):
+                    center = (int(tank.x + tank.width / 2.0), int(tank.y + tank.width / 2.0))
+                    self.assertEqual(tuple(obs['loc'][i, k]), center)
+        self.assertTrue(all(stats is not None for stats in vec.stats))
+        # The games are set up again on new fields, without a nav mesh
+        self.assertEqual(vec.games, games)
+        self.assertTrue(all(game.field._unpacked['mesh'] is None for game in vec.games))
+
+    def test_lazy_observations(self):
+        settings = core.Settings(max_steps=50, lazy_observations=True)
+        game = core.Game(red=RANDOM_AGENT, blue=RANDOM_AGENT, settings=settings,
+                         rendered=False, verbose=False)
+        game.run()
+        # The random agent reads nothing, so only the last observations are filled in
+        self.assertEqual(game.stats.observations, 50 * len(game.tanks))
+        self.assertEqual(game.stats.observed_objects, len(game.tanks))
+        for tank in game.tanks:
+            self.assertEqual(len(tank.observation.walls), len(tank.observation.walls[0]))
+
+    def test_workers(self):
+        settings = core.Settings(max_steps=50, think_time=1.0)
+        game = core.Game(red=RANDOM_AGENT, blue=TEAM_AGENT, settings=settings,
+                         record=True, rendered=False, verbose=False, workers=True)
+        game.run()
+        self.assertFalse(game.red.raised_exception or game.blue.raised_exception)
+        self.assertTrue(all(not worker.process.is_alive() for worker in game.workers))
+        # The agents always shoot, so they must have acted
+        self.assertTrue(any(shoot for actions in game.replay.actions_red for (_, _, shoot) in actions))
+        self.assertTrue(any(shoot for actions in game.replay.actions_blue for (_, _, shoot) in actions))
+
+    def test_worker_timeout(self):
+        agent = RANDOM_AGENT.replace("return (-pi", "import time\n        time.sleep(5)\n        return (-pi")
+        settings = core.Settings(max_steps=3, think_time=0.05)
+        game = core.Game(red=agent, blue=RANDOM_AGENT, settings=settings,
+                         rendered=False, verbose=False, workers=True)
+        start = time.monotonic()
+        game.run()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(game.red.raised_exception)
+        self.assertFalse(game.blue.raised_exception)
+        self.assertTrue(all(not worker.process.is_alive() for worker in game.workers))
+
     def test_tournament(self):
         tmpdir = '_tmp'
         if not os.path.exists(tmpdir):
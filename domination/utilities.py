@@ -12,6 +12,7 @@ import copy
 from pprint import pprint
 from heapq import heappush, heappop
 from sys import maxsize
+from types import MappingProxyType
 
 # Local libs
 from .libs import astar
@@ -39,6 +40,35 @@ def all_pairs(seq):
         for j in range(i+1, l):
             yield seq[i], seq[j]
 
+def freeze(obj):
+    """ Returns a read-only version of nested lists and dicts,
+        lists become tuples and dicts become read-only mappings.
+        
+        >>> freeze({(0, 0): {(1, 0): 1.0}})[(0, 0)][(1, 0)]
+        1.0
+        >>> freeze([[0, 1], [1, 0]])
+        ((0, 1), (1, 0))
+    """
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(o) for o in obj)
+    if isinstance(obj, (dict, MappingProxyType)):
+        return MappingProxyType(dict((k, freeze(v)) for (k, v) in obj.items()))
+    return obj
+    
+def thaw(obj):
+    """ Returns a mutable copy of a frozen structure, read-only
+        mappings become dicts and tuples become lists. Keys are
+        left alone.
+        
+        >>> thaw(freeze([[0, 1], [1, 0]]))
+        [[0, 1], [1, 0]]
+    """
+    if isinstance(obj, (list, tuple)):
+        return [thaw(o) for o in obj]
+    if isinstance(obj, (dict, MappingProxyType)):
+        return dict((k, thaw(v)) for (k, v) in obj.items())
+    return obj
+
 ### NUMERICAL ###
 
 def frange(limit1, limit2 = None, increment = 1.):
@@ -340,6 +370,89 @@ def rects_merge(rects):
     # Stack twice, once in each direction
     return stack(stack(rects),horizontal=True)
 
+class RectGrid(object):
+    """ Buckets rectangles on a grid of square cells, so that the
+        rectangles at a point or along a line can be found without
+        testing all of them. Each rectangle is put in every cell
+        that it touches, grown by a margin.
+
+        >>> grid = RectGrid([(0,0,10,10), (40,0,10,10)])
+        >>> grid.line_hits((5,20), (45,5))
+        True
+        >>> grid.line_hits((20,0), (30,40))
+        False
+    """
+    def __init__(self, rects, cellsize=32, margin=1):
+        self.rects    = list(rects)
+        self.cellsize = float(cellsize)
+        self.cells    = {} # Maps (i, j) to a list of indices of rects
+        for (k, (x, y, w, h)) in enumerate(self.rects):
+            imin, imax = self._cell(y - margin), self._cell(y + h + margin)
+            jmin, jmax = self._cell(x - margin), self._cell(x + w + margin)
+            for i in range(imin, imax + 1):
+                for j in range(jmin, jmax + 1):
+                    self.cells.setdefault((i, j), []).append(k)
+
+    def _cell(self, v):
+        return int(math.floor(v / self.cellsize))
+
+    def at(self, point):
+        """ Returns the rects in the cell that contains the point. """
+        cell = self.cells.get((self._cell(point[1]), self._cell(point[0])), ())
+        return [self.rects[k] for k in cell]
+
+    def line_hits(self, p0, p1):
+        """ Returns True if the line from p0 to p1 intersects any of the
+            rects, like line_intersects_rect does, but only tests the
+            rects in the cells that the line passes through.
+        """
+        cs = self.cellsize
+        x0, y0, x1, y1 = p0[0] / cs, p0[1] / cs, p1[0] / cs, p1[1] / cs
+        dx, dy = abs(x1 - x0), abs(y1 - y0)
+        x, y = int(math.floor(x0)), int(math.floor(y0))
+        n = 1
+        # Walk the cells in the same way as line_intersects_grid
+        if dx == 0:
+            x_inc, t_next_h, dt_dx = 0, inf, inf
+        else:
+            dt_dx = 1.0 / dx
+            if x1 > x0:
+                x_inc = 1
+                n += int(math.floor(x1)) - x
+                t_next_h = (math.floor(x0) + 1 - x0) * dt_dx
+            else:
+                x_inc = -1
+                n += x - int(math.floor(x1))
+                t_next_h = (x0 - math.floor(x0)) * dt_dx
+        if dy == 0:
+            y_inc, t_next_v, dt_dy = 0, inf, inf
+        else:
+            dt_dy = 1.0 / dy
+            if y1 > y0:
+                y_inc = 1
+                n += int(math.floor(y1)) - y
+                t_next_v = (math.floor(y0) + 1 - y0) * dt_dy
+            else:
+                y_inc = -1
+                n += y - int(math.floor(y1))
+                t_next_v = (y0 - math.floor(y0)) * dt_dy
+        cells, rects = self.cells, self.rects
+        tested = set()
+        while n > 0:
+            for k in cells.get((y, x), ()):
+                if k not in tested:
+                    tested.add(k)
+                    if line_intersects_rect(p0, p1, rects[k]):
+                        return True
+            if t_next_v < t_next_h:
+                y += y_inc
+                t_next_v += dt_dy
+            else:
+                x += x_inc
+                t_next_h += dt_dx
+            n -= 1
+        return False
+
 def angle_fix(theta):
     """ Fixes an angle to a value between -pi and pi.
         
@@ -427,28 +540,32 @@ def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
         the world bounds (a big rectangle).
         Mesh is a dictionary of dictionaries:
             mesh[point1][point2] = distance
+        
+        The walls are bucketed in a :class:`RectGrid`, so a line 
+        of sight is only tested against the walls that it passes.
+        
+        >>> sorted(make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)[(1, 1)])
+        [(1, 4), (4, 1)]
     """
     # If bounds not given, assume outer walls are bounds.
     if bounds is None:
         bounds = rects_bound(walls)
     # 1) Offset walls and add nodes on corners
     walls = [rect_offset(w,offset) for w in walls]
+    grid = RectGrid(walls)
     nodes = set(add_points)
     for w in walls:
         for point in rect_corners(w):
     # 2) Remove points that are inside of other walls (or outside bounds)
-            other_walls = [x for x in walls if x!=w]
             if (rect_contains_point(bounds, point) and 
-                not any(rect_contains_point(ow, point) for ow in other_walls)):
+                not any(rect_contains_point(ow, point) for ow in grid.at(point) if ow != w)):
                 nodes.add((int(point[0]),int(point[1])))
-    # 3) Connect nodes that can "see" eachother
-    walls = [rect_offset(w,-0.001) for w in walls]
+    # 3) Connect nodes that can "see" eachother, sight goes both ways
+    grid = RectGrid([rect_offset(w,-0.001) for w in walls])
     mesh = dict((n,{}) for n in nodes)
-    for n1 in nodes:
-        for n2 in nodes:
-            if n1 != n2:
-                if not any(line_intersects_rect(n1,n2,w) for w in walls):
-                    mesh[n1][n2] = point_dist(n1,n2)
+    for (n1, n2) in all_pairs(sorted(nodes)):
+        if not grid.line_hits(n1, n2):
+            mesh[n1][n2] = mesh[n2][n1] = point_dist(n1,n2)
     # 4) Remove direct connections that are not much shorter than indirect ones
     def astar_path_length(m, start, end):
         """ Length of a path from start to end """
@@ -465,9 +582,14 @@ def make_nav_mesh(walls, bounds=None, offset=7, simplify=0.001, add_points=[]):
     connections.sort(reverse=True) # Start with the longest connections
     for length, (n1, n2) in connections:
         mesh[n1].pop(n2) # Remove connection to see best path without it
+        # Most connections have a detour through a single node that is short 
+        # enough (triangle inequality), only search when there isn't one.
+        longest = (1+simplify) * length
+        if any(d + mesh[n][n2] <= longest for (n, d) in mesh[n1].items() if n2 in mesh[n]):
+            continue
         alternative_dist = astar_path_length(mesh, n1,n2)
         # Put the connection back if the alternative is much worse
-        if alternative_dist > (1+simplify) * length:
+        if alternative_dist > longest:
             mesh[n1][n2] = length
         
     return mesh
@@ -481,22 +603,39 @@ def find_path(start, end, mesh, grid, tilesize=16):
         >>> mesh = make_nav_mesh([(2,2,1,1)],(0,0,4,4),1)
         >>> find_path((0,0),(4,4),mesh,grid,1)
         [(4, 1), (4, 4)]
+        
+        The points can be any pair of coordinates, like the numpy
+        arrays of observation_type 'numpy'.
     """
+    # Points are used as nodes, so they have to be hashable.
+    (start, end) = (tuple(start), tuple(end))
     # If there is a straight line, just return the end point
     if not line_intersects_grid(start, end, grid, tilesize):
         return [end]
-    # Copy mesh so we can add temp nodes
-    mesh = copy.deepcopy(mesh)
-    # Add temp notes for start
-    mesh[start] = dict([(n, point_dist(start,n)) for n in mesh if not line_intersects_grid(start,n,grid,tilesize)])
-    # Add temp nodes for end:
-    if end not in mesh:
-        endconns = [(n, point_dist(end,n)) for n in mesh if not line_intersects_grid(end,n,grid,tilesize)]
-        for n, dst in endconns:
-            mesh[n][end] = dst
+    # Temp edges for start and end are kept aside, the mesh is not changed,
+    # so that it can be shared (and read-only).
+    nodes = list(mesh)
+    start_edges = dict([(n, point_dist(start,n)) for n in nodes if not line_intersects_grid(start,n,grid,tilesize)])
+    if start not in mesh:
+        nodes.append(start)
+    end_edges = {}
+    if end not in mesh and end != start:
+        end_edges = dict([(n, point_dist(end,n)) for n in nodes if not line_intersects_grid(end,n,grid,tilesize)])
+    
+    def edges(n):
+        return start_edges if n == start else mesh[n]
+    
+    def neighbours(n):
+        ns = list(edges(n).keys())
+        if n in end_edges:
+            ns.append(end)
+        return ns
+        
+    def cost(n1, n2):
+        if n2 == end and n1 in end_edges:
+            return end_edges[n1]
+        return edges(n1)[n2]
     
-    neighbours = lambda n: list(mesh[n].keys())
-    cost       = lambda n1, n2: mesh[n1][n2]
     goal       = lambda n: n == end
     heuristic  = lambda n: ((n[0]-end[0]) ** 2 + (n[1]-end[1]) ** 2) ** 0.5
     nodes, length = astar(start, neighbours, goal, 0, cost, heuristic)
@@ -507,19 +646,19 @@ tictocs = {}
 
 def tic(timer_id='default'):
     try:
-        tictocs[timer_id][0] = time.clock()
+        tictocs[timer_id][0] = time.perf_counter()
     except KeyError:
-        tictocs[timer_id] = [time.clock(),0.0]
+        tictocs[timer_id] = [time.perf_counter(),0.0]
 
 def toc(timer_id='default'):
     try:
         p, a = tictocs[timer_id]
-        d = time.clock() - p
+        d = time.perf_counter() - p
         tictocs[timer_id][1] *= 0.9
         tictocs[timer_id][1] += 0.1 * d
         return d
     except KeyError:
-        tictocs[timer_id] = [time.clock(),0.0]
+        tictocs[timer_id] = [time.perf_counter(),0.0]
         return 0.0
 
 def toc_avg(timer_id='default'):
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+""" Vectorized games for domination game engine.
+
+This module steps a number of games together, for training agents that play
+many short games. The games have no brains, the actions of all tanks are given
+as one array, and the observations of all tanks in all games are filled into
+stacked NumPy arrays (see :mod:`~domination.arrays`). You need numpy to use it.
+
+    >>> vec = VecGame(16, settings=Settings(max_steps=100))
+    >>> obs = vec.reset()
+    >>> obs['loc'].shape
+    (16, 12, 2)
+    >>> obs, rewards, dones = vec.step(np.zeros((16, 12, 3)))
+
+Tanks are ordered red first, then blue, by id. Games that are over are
+replaced by a new game on a new field from the generator, so the observations
+that step returns for them are the first of the new game.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+# Python
+import sys
+import copy
+
+# Libraries
+import numpy as np
+
+# Local
+from . import core
+from . import arrays
+from .core import Settings
+
+### CLASSES ###
+
+class VecGame(object):
+    """ Steps a number of brainless games in lockstep. Each phase of
+        a step is done for all games before the next one starts.
+    """
+
+    def __init__(self, num_games, settings=None, generator=None, physics='python'):
+        """ Constructor for VecGame class
+
+            :param num_games: The number of games to run at the same time.
+            :param settings:  Instance of the settings class.
+            :param generator: The FieldGenerator for the fields of new games,
+                              all fields must have the same number of tanks
+                              and control points.
+            :param physics:   The collision solver to use, 'python' or 'numpy'.
+        """
+        self.num_games = num_games
+        self.settings = copy.copy(settings) if settings is not None else Settings()
+        self.settings.observation_type = 'python'
+        self.generator = generator if generator is not None else core.FieldGenerator()
+        self.physics = physics
+        self.games = [None] * num_games
+        self.stats = [None] * num_games #: The GameStats of the last game that ended, for each game
+        self.observations = None  #: A dict of the stacked observation arrays, filled in place
+
+    def reset(self):
+        """ Starts new games, returns the observations. """
+        for i in range(self.num_games):
+            self._new_game(i)
+        self._each('_begin_step')
+        return self.observations
+
+    def step(self, actions):
+        """ Does one step in all games, returns the observations,
+            the rewards and whether each game ended.
+
+            :param actions: An array of shape (games, tanks, 3) with a
+                            (turn, speed, shoot) for each tank.
+            :returns: A tuple of the observations, an array of shape (games, 2)
+                      with the points that red and blue scored, and a boolean
+                      array with the games that ended.
+        """
+        # Python floats, arithmetic on numpy scalars would slow down the physics
+        actions = np.asarray(actions, dtype=float).tolist()
+        scores = np.array([(g.score_red, g.score_blue) for g in self.games], dtype=float)
+        for (game, game_actions) in zip(self.games, actions):
+            for (tank, (turn, speed, shoot)) in zip(game.tanks, game_actions):
+                tank.team_action = (turn, speed, shoot > 0.5)
+        self._each('_act')
+        dones = np.array(self._each('_end_step'), dtype=bool)
+        rewards = np.array([(g.score_red, g.score_blue) for g in self.games], dtype=float) - scores
+        for i in np.flatnonzero(dones):
+            game = self.games[i]
+            self._run(game, game._end)
+            self.stats[i] = game.stats
+            self._new_game(i)
+        self._each('_begin_step')
+        return self.observations, rewards, dones
+
+    def _each(self, method):
+        """ Calls the method on all games, returns the results. """
+        return [self._run(game, getattr(game, method)) for game in self.games]
+
+    def _run(self, game, method):
+        # Print to the log of the game
+        stdout, sys.stdout = sys.stdout, game.log
+        try:
+            return method()
+        finally:
+            sys.stdout = stdout
+
+    def _new_game(self, i):
+        """ Starts a new game on a new field in place of game i. The
+            game object is set up again, only the first one is created.
+        """
+        field = self.generator.generate()
+        game = self.games[i]
+        if game is None:
+            game = core.Game(red=None, blue=None, settings=self.settings, field=field,
+                             rendered=False, verbose=False, physics=self.physics)
+        else:
+            game.field = field
+        self._run(game, lambda: game._setup(brains=False))
+        if self.observations is None:
+            self._allocate(game)
+        # Point the game's observations into the stacked arrays
+        n = len(game.tanks_red)
+        out_red = dict((name, a[i, :n]) for (name, a) in self.observations.items() if name != 'cps')
+        out_blue = dict((name, a[i, n:]) for (name, a) in self.observations.items() if name != 'cps')
+        out_red['cps'] = out_blue['cps'] = self.observations['cps'][i]
+        out_red['friends'] = out_red['friends'][:, :max(n - 1, 0)]
+        out_red['foes'] = out_red['foes'][:, :len(game.tanks_blue)]
+        out_blue['friends'] = out_blue['friends'][:, :max(len(game.tanks_blue) - 1, 0)]
+        out_blue['foes'] = out_blue['foes'][:, :n]
+        game.observation_arrays = [arrays.ObservationArrays(game, game.tanks_red, out_red),
+                                   arrays.ObservationArrays(game, game.tanks_blue, out_blue)]
+        game.state = core.Game.STATE_RUNNING
+        self.games[i] = game
+
+    def _allocate(self, game):
+        """ Allocates the stacked arrays, with shapes from the given game. """
+        num, n = self.num_games, len(game.tanks)
+        most = max(len(game.tanks_red), len(game.tanks_blue))
+        gridrng = int((self.settings.max_see/2+1)//game.field.tilesize)
+        size = gridrng * 2 + 1
+        self.observations = {
+            'loc':         np.zeros((num, n, 2), dtype=int),
+            'angle':       np.zeros((num, n), dtype=float),
+            'ammo':        np.zeros((num, n), dtype=int),
+            'walls':       np.zeros((num, n, size, size), dtype=np.int8),
+            'friends':     np.zeros((num, n, max(most - 1, 0), 2), dtype=int),
+            'num_friends': np.zeros((num, n), dtype=int),
+            'foes':        np.zeros((num, n, most, 3), dtype=float),
+            'num_foes':    np.zeros((num, n), dtype=int),
+            'cps':         np.zeros((num, len(game.controlpoints), 3), dtype=int)}
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+""" Worker processes for domination game engine.
+
+This module runs the agents of each team in a separate process, that talks to
+the game over a pipe. The teams think at the same time, and the game does not
+wait for a team longer than its think time (``think_time`` for each agent).
+Agents that haven't answered by then do nothing (NO-OP) in that step, and if
+a team is still thinking when the next step starts, it skips that step: its
+agents won't observe it and do nothing. A worker that takes too long to set
+up its agents, or to finalize them at the end of the game, is terminated. 
+Enable it with ``Game(workers=True)``.
+
+Agents can't draw on the renderer from a worker, so debug() is not called.
+Anything they print is sent back to the game log.
+
+"""
+__author__ = "Thomas van den Berg and Tim Doolan"
+
+### IMPORTS ###
+import sys
+import time
+import signal
+import traceback
+import multiprocessing
+
+# Local
+from . import core
+
+### CLASSES ###
+
+class TeamWorker(object):
+    """ Runs the brains of one team in a worker process. """
+    
+    READY_TIME    = 10.0 #: Seconds the worker may take to construct the brains
+    FINALIZE_TIME = 2.0  #: Seconds the worker may take to finalize, before it is stopped
+
+    def __init__(self, game, team_obj, tanks):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            context = multiprocessing.get_context()
+        self.game = game
+        self.team_obj = team_obj
+        self.tanks = tanks
+        self.team = tanks[0].team if tanks else core.TEAM_NEUTRAL
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_work,
+                                       args=(child_conn, team_obj, self.team, len(tanks),
+                                             game.settings, game.field, game._agent_scope()))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.busy = None    # The step that the worker is thinking about
+        self.actions = {}
+        self.ready = False
+
+    def wait_ready(self):
+        """ Waits until the worker has constructed the brains, for at most
+            READY_TIME seconds. If it takes longer, the worker is stopped
+            and its agents do nothing for the rest of the game.
+        """
+        deadline = time.monotonic() + self.READY_TIME
+        try:
+            while not self.ready:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    self._stop('constructing its agents')
+                    return
+                self._handle(self.conn.recv())
+        except (EOFError, OSError):
+            self._stop('constructing its agents')
+
+    def send(self, step):
+        """ Sends the observations of this step to the worker, unless it
+            is still thinking about a previous one. Returns whether it did.
+        """
+        self.actions = {}
+        if not self.process.is_alive():
+            return False
+        while self.busy is not None and self.conn.poll(0):
+            self._handle(self.conn.recv())
+        if self.busy is not None:
+            return False
+        self.busy = step
+        self.conn.send(('step', step, [tank.observation for tank in self.tanks]))
+        return True
+
+    def collect(self, step, deadline):
+        """ Receives actions until the worker is done with the step, or the
+            deadline (a time.monotonic()) has passed, and gives them to the tanks.
+        """
+        while self.busy == step and self.process.is_alive():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.conn.poll(remaining):
+                break
+            self._handle(self.conn.recv())
+        think_time = self.game.settings.think_time
+        for tank in self.tanks:
+            if tank.id in self.actions:
+                (action, observe_ns, action_ns) = self.actions[tank.id]
+            else:
+                (action, observe_ns, action_ns) = (None, 0, int(think_time * 1e9))
+            time_thought = (observe_ns + action_ns) * 1e-9
+            # Ignore action (NO-OP) if agent thought too long.
+            if action is None or time_thought > think_time:
+                action = (0,0,False)
+                print('[Game]: Agent %s-%d timed out (%.3fs).'%('RED' if self.team == core.TEAM_RED else 'BLU', tank.id, time_thought))
+            tank.team_action = action
+            tank.time_thought = time_thought
+            tank.observe_ns = observe_ns
+            tank.action_ns = action_ns
+
+    def finalize(self, interrupted=False):
+        """ Lets the brains finalize, and stops the worker. A worker that
+            is still thinking, or that doesn't finish finalizing within 
+            FINALIZE_TIME seconds, is terminated.
+        """
+        deadline = time.monotonic() + self.FINALIZE_TIME
+        try:
+            if self.process.is_alive():
+                self.conn.send(('finalize', interrupted))
+            # The worker closes the pipe when it is done
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    self._stop('finalizing')
+                    break
+                self._handle(self.conn.recv())
+        except (EOFError, OSError):
+            pass
+        self.process.join(self.FINALIZE_TIME)
+
+    def _stop(self, doing):
+        """ Terminates a worker that took too long. """
+        if self.process.is_alive():
+            print('[Game]: Team %s timed out %s, stopping its worker.'%('RED' if self.team == core.TEAM_RED else 'BLU', doing))
+            self.team_obj.raised_exception = True
+            self.process.terminate()
+            self.process.join(self.FINALIZE_TIME)
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == 'action':
+            (_, step, i, action, observe_ns, action_ns) = message
+            if step == self.busy:
+                self.actions[i] = (action, observe_ns, action_ns)
+        elif kind == 'done':
+            if message[1] == self.busy:
+                self.busy = None
+        elif kind == 'ready':
+            self.ready = True
+        elif kind == 'output':
+            sys.stdout.write(message[1])
+        elif kind == 'exception':
+            (_, method, text) = message
+            self.team_obj.raised_exception = True
+            print("\n%s raised exception in < %s() >" % ('RED' if self.team == core.TEAM_RED else 'BLU', method))
+            print('-' * 60)
+            sys.stdout.write(text)
+            print('-' * 60)
+            if self.game.hard_errors:
+                raise Exception("Agent raised exception in %s()" % method)
+
+
+class _PipeWriter(object):
+    """ Sends whatever the agents print to the game. """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        self.conn.send(('output', text))
+
+    def flush(self):
+        pass
+
+### FUNCTIONS ###
+
+def _work(conn, team_obj, team, num_agents, settings, field, scope):
+    """ Main loop of the worker process. """
+    sys.stdout = _PipeWriter(conn)
+    # The game handles interrupts, and tells us to finalize.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def call(method, args=[], kwargs={}, default=None):
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            conn.send(('exception', method.__name__, traceback.format_exc()))
+            return default
+
+    # Construct the brains like the game does
+    brain_kwargs = {}
+    if settings.field_known:
+        (rects, grid, mesh) = field.frozen()
+        brain_kwargs.update({'field_rects': rects, 'field_grid': grid, 'nav_mesh': mesh})
+    brainclass = call(team_obj.load, kwargs={'scope': scope}, default=core.AgentStub)
+
+    def construct(args, default):
+        kwargs = dict(brain_kwargs, settings=core.copy.copy(settings))
+        kwargs.update(team_obj.init_kwargs)
+        return call(brainclass, args=args, kwargs=kwargs, default=default)
+
+    if team_obj.batched:
+        team_brain = construct([num_agents, team], core.TeamBrain(num_agents, team))
+        brains = [team_brain]
+    else:
+        brains = [construct([i, team], core.AgentStub()) for i in range(num_agents)]
+    conn.send(('ready',))
+
+    while True:
+        message = conn.recv()
+        if message[0] == 'step':
+            (_, step, observations) = message
+            if team_obj.batched:
+                def _act():
+                    actions = list(team_brain.action())
+                    if len(actions) != num_agents or any(a is None or len(a) != 3 for a in actions):
+                        raise Exception("Actions should be a list of 3-tuples of (turn, speed, shoot), one per agent")
+                    return actions
+                last_clock = time.perf_counter_ns()
+                call(team_brain.observe, args=[observations])
+                observe_ns = time.perf_counter_ns() - last_clock
+                actions = call(_act, default=[(0,0,False)] * num_agents)
+                action_ns = time.perf_counter_ns() - last_clock - observe_ns
+                for (i, action) in enumerate(actions):
+                    conn.send(('action', step, i, tuple(action), 
+                               observe_ns // num_agents, action_ns // num_agents))
+            else:
+                times = []
+                for (brain, obs) in zip(brains, observations):
+                    last_clock = time.perf_counter_ns()
+                    call(brain.observe, args=[obs])
+                    times.append(time.perf_counter_ns() - last_clock)
+                for (i, brain) in enumerate(brains):
+                    def _act():
+                        action = brain.action()
+                        if action is None or len(action) != 3:
+                            raise Exception("Action should be a 3-tuple of (turn, speed, shoot)")
+                        return action
+                    last_clock = time.perf_counter_ns()
+                    action = call(_act, default=(0,0,False))
+                    conn.send(('action', step, i, tuple(action), times[i], time.perf_counter_ns() - last_clock))
+            conn.send(('done', step))
+        elif message[0] == 'finalize':
+            for brain in brains:
+                call(brain.finalize, args=[message[1]])
+            break
+    conn.close()